@@ -0,0 +1,64 @@
+"""
+运算查找表和 N Z 标志的延迟计算
+
+N Z 标志
+    CPU 不单独保存 N 和 Z, 只保存最后一次设置它们的结果 _nz, 用到的时候再算
+        Z = (_nz & 0xFF) == 0
+        N = (_nz & 0x8080) != 0
+    普通指令的结果是一个字节, 直接存进 _nz
+    BIT 的 N 来自内存的第 7 位, 和 Z 无关, 放在第 15 位
+    PLP RTI 直接设置标志时用 nz_from_status 换算
+
+查找表
+    ADC_TABLE   下标是 (C << 16) | (A << 8) | M, SBC 查 M ^ 0xFF
+                值是 结果 | C << 8 | V << 9
+    ASL_TABLE LSR_TABLE   下标是操作数
+    ROL_TABLE ROR_TABLE   下标是 (C << 8) | 操作数
+                值是 结果 | C << 8
+"""
+
+
+def _build_adc_table():
+    table = [0] * 0x20000
+    for carry in range(2):
+        for a in range(256):
+            for value in range(256):
+                result = a + value + carry
+                overflow = 1 if (a ^ result) & (value ^ result) & 0x80 else 0
+                table[(carry << 16) | (a << 8) | value] = result | (overflow << 9)
+    return table
+
+
+def _build_shift_table(shift):
+    return [shift(carry, value) for carry in range(2) for value in range(256)]
+
+
+ADC_TABLE = _build_adc_table()
+ASL_TABLE = _build_shift_table(lambda carry, value: value << 1)[:256]
+LSR_TABLE = _build_shift_table(lambda carry, value: (value >> 1) | ((value & 1) << 8))[:256]
+ROL_TABLE = _build_shift_table(lambda carry, value: (value << 1) | carry)
+ROR_TABLE = _build_shift_table(lambda carry, value: (value >> 1) | (carry << 7) | ((value & 1) << 8))
+
+# 生成的代码里用到的查找表, 按名字传给 _build
+TABLES = {
+    'adc_table': ADC_TABLE,
+    'asl_table': ASL_TABLE,
+    'lsr_table': LSR_TABLE,
+    'rol_table': ROL_TABLE,
+    'ror_table': ROR_TABLE,
+}
+
+
+def nz_from_status(status):
+    """
+    用状态寄存器的 N Z 位构造 _nz
+    """
+    return ((status & 0x80) << 8) | (((status >> 1) & 1) ^ 1)
+
+
+def flag_z(nz):
+    return 0 if nz & 0xFF else 1
+
+
+def flag_n(nz):
+    return 1 if nz & 0x8080 else 0
@@ -0,0 +1,178 @@
+"""
+性能测试, 不打开窗口
+
+python benchmark.py [frames]
+"""
+import sys
+import time
+
+from console import Console
+from compositor import numpy
+
+
+ROMS = ['mario.nes', 'balloon.nes']
+DISPATCHES = ['table', 'generated', 'recompiled']
+SCHEDULERS = ['step', 'run_frame']
+COMPOSITORS = ['python', 'numpy']
+FRAMESKIPS = [0, 1, 3]
+
+
+def benchmark(rom, dispatch, frames):
+    """
+    默认设置 (run_frame 调度, 跳过空转循环) 下执行, 只统计 CPU.run 的耗时
+    不同分发方式执行的指令完全相同, 每秒周期数的比值就是每秒指令数的比值
+    """
+    console = Console(rom, dispatch=dispatch)
+    cpu = console.cpu
+    run = cpu.run
+    clock = time.perf_counter
+    cpu_time = 0
+
+    def timed_run(cycles):
+        nonlocal cpu_time
+        start = clock()
+        result = run(cycles)
+        cpu_time += clock() - start
+        return result
+
+    cpu.run = timed_run
+    ppu = console.ppu
+    target = ppu.frame + frames
+    start = clock()
+    while ppu.frame < target:
+        console.run_frame()
+    elapsed = clock() - start
+    console.close()
+    return cpu.cycles, cpu_time, elapsed
+
+
+def benchmark_scheduler(rom, scheduler, frames):
+    """
+    step 每条指令之后同步一次 PPU, run_frame 用 catch-up 调度
+    """
+    console = Console(rom, idle_skip=False)
+    run = getattr(console, scheduler)
+    ppu = console.ppu
+    target = ppu.frame + frames
+    start = time.perf_counter()
+    while ppu.frame < target:
+        run()
+    elapsed = time.perf_counter() - start
+    console.close()
+    return elapsed
+
+
+def benchmark_idle(rom, idle_skip, frames):
+    """
+    :return: 耗时, 平均每帧跳过的周期
+    """
+    console = Console(rom, idle_skip=idle_skip)
+    ppu = console.ppu
+    target = ppu.frame + frames
+    skipped = 0
+    start = time.perf_counter()
+    while ppu.frame < target:
+        console.run_frame()
+        skipped += console.skipped_cycles
+    elapsed = time.perf_counter() - start
+    console.close()
+    return elapsed, skipped / frames
+
+
+def benchmark_compositor(rom, compositor, frames):
+    """
+    先运行到有画面, 再单独计算每帧合成的耗时
+    :return: 耗时
+    """
+    console = Console(rom, compositor=compositor)
+    for _ in range(frames):
+        console.run_frame()
+    ppu = console.ppu
+    start = time.perf_counter()
+    for _ in range(frames):
+        ppu.compose()
+    elapsed = time.perf_counter() - start
+    console.close()
+    return elapsed
+
+
+def benchmark_frameskip(rom, frameskip, frames):
+    """
+    跳过的帧只有 CPU 和事件的开销
+    """
+    console = Console(rom)
+    console.ppu.frameskip = frameskip
+    start = time.perf_counter()
+    for _ in range(frames):
+        console.run_frame()
+    elapsed = time.perf_counter() - start
+    console.close()
+    return elapsed
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    print('指令分发')
+    for rom in ROMS:
+        # 每秒周期数, 和 table 以及 generated 比较
+        speeds = {}
+        for dispatch in DISPATCHES:
+            cycles, cpu_time, elapsed = benchmark(rom, dispatch, frames)
+            speed = cycles / cpu_time
+            speeds[dispatch] = speed
+            print('{:<12} {:<10} {:>8} 周期 总耗时 {:>6.2f}s CPU {:>6.2f}s {:>9.0f} 周期/秒 {:>5.2f}x table {:>5.2f}x generated'.format(
+                rom, dispatch, cycles, elapsed, cpu_time, speed,
+                speed / speeds['table'], speed / speeds.get('generated', speed)))
+        if speeds['recompiled'] <= speeds['generated']:
+            print('{:<12} recompiled 没有比 generated 快, 帧数太少时编译的开销占大头'.format(rom))
+
+    print('调度')
+    for rom in ROMS:
+        baseline = None
+        for scheduler in SCHEDULERS:
+            elapsed = benchmark_scheduler(rom, scheduler, frames)
+            fps = frames / elapsed
+            if baseline is None:
+                baseline = fps
+            print('{:<12} {:<10} {:>6.2f}s {:>7.2f} 帧/秒 {:>5.2f}x'.format(
+                rom, scheduler, elapsed, fps, fps / baseline))
+
+    print('空转循环')
+    for rom in ROMS:
+        baseline = None
+        for idle_skip in (False, True):
+            elapsed, skipped = benchmark_idle(rom, idle_skip, frames)
+            fps = frames / elapsed
+            if baseline is None:
+                baseline = fps
+            print('{:<12} {:<10} {:>6.2f}s {:>7.2f} 帧/秒 {:>5.2f}x 每帧跳过 {:>7.0f} 周期'.format(
+                rom, 'skip' if idle_skip else 'off', elapsed, fps, fps / baseline, skipped))
+
+    print('帧合成')
+    for rom in ROMS:
+        baseline = None
+        for compositor in COMPOSITORS:
+            if compositor == 'numpy' and numpy is None:
+                print('{:<12} {:<10} 没有安装 numpy'.format(rom, compositor))
+                continue
+            elapsed = benchmark_compositor(rom, compositor, frames)
+            fps = frames / elapsed
+            if baseline is None:
+                baseline = fps
+            print('{:<12} {:<10} {:>6.2f}s {:>7.2f} 帧/秒 {:>5.2f}x'.format(
+                rom, compositor, elapsed, fps, fps / baseline))
+
+    print('跳帧')
+    for rom in ROMS:
+        baseline = None
+        for frameskip in FRAMESKIPS:
+            elapsed = benchmark_frameskip(rom, frameskip, frames)
+            fps = frames / elapsed
+            if baseline is None:
+                baseline = fps
+            print('{:<12} {:<10} {:>6.2f}s {:>7.2f} 帧/秒 {:>5.2f}x'.format(
+                rom, frameskip, elapsed, fps, fps / baseline))
+
+
+if __name__ == '__main__':
+    main()
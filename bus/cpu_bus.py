@@ -3,71 +3,224 @@ from memory.write import MemoryWrite
 
 
 class CPUBus(MemoryRead, MemoryWrite):
+    """
+    页表
+        $0000-$FFFF 分成 256 页, 每页 256 字节, 初始化时为每页设置好读写方式
+        内存页 (RAM 和它的镜像、SRAM、PRG-ROM) 直接记录背后的内存和偏移, 读写只需要一次下标访问
+        PPU 寄存器页 ($2000-$3FFF) 和 IO 页 ($4000-$40FF) 用处理函数
+
+        PRG-ROM 页由卡带映射, mapper 切换 bank 时用 map_rom 修改页表
+        写 $8000-$FFFF 是写 mapper 的寄存器
+    """
     def __init__(self, cpu, ppu, ram, sram, cartridge, joypad, IO_registers):
         self._ram = ram
         self._sram = sram
         self._cartridge = cartridge
         self._IO_registers = IO_registers
         self._joypad = joypad
+        self._console = None
+        self._recompiler = None
         self._cpu = cpu
-        self._cpu.connect_to_bus(self)
         self._ppu = ppu
+        self._setup_pages()
+        self._cpu.connect_to_bus(self)
         self._ppu.connect_to_cpu_bus(self)
 
+    def _setup_pages(self):
+        # 内存页: 背后的内存和这一页在内存里的偏移, 处理函数页的内存是 None
+        self._read_memory = [None] * 256
+        self._read_offsets = [0] * 256
+        self._readers = [None] * 256
+        self._write_memory = [None] * 256
+        self._write_offsets = [0] * 256
+        self._writers = [None] * 256
+
+        # 2KB RAM 镜像到 $0000-$1FFF
+        for page in range(0x00, 0x20):
+            self.map_page(page, self._ram.data, (page & 0x07) << 8)
+        # PPU 寄存器每 8 字节镜像一次
+        for page in range(0x20, 0x40):
+            self.map_handler(page, self._read_ppu_register, self._write_ppu_register)
+        self.map_handler(0x40, self._read_io, self._write_io)
+        for page in range(0x41, 0x60):
+            self.map_handler(page, self._read_expansion, self._write_expansion)
+        for page in range(0x60, 0x80):
+            self.map_page(page, self._sram.data, (page - 0x60) << 8)
+        # PRG-ROM 由卡带映射, 写交给 mapper
+        for page in range(0x80, 0x100):
+            self.map_handler(page, None, self._write_prg)
+        self._cartridge.connect_to_cpu_bus(self)
+
+    def map_page(self, page, memory, offset, writable=True):
+        """
+        把一页映射到 memory[offset:offset + 256]
+        不可写的页保留原来的写处理函数
+        """
+        self._read_memory[page] = memory
+        self._read_offsets[page] = offset
+        if writable:
+            self._write_memory[page] = memory
+            self._write_offsets[page] = offset
+
+    def map_rom(self, page, count, memory, offset):
+        """
+        mapper 切换 PRG bank, 从 page 开始的 count 页只读映射到 memory[offset:]
+        只用切片赋值改这几项页表, 再作废 CPU 对这一段 ROM 的缓存
+        """
+        end = page + count
+        self._read_memory[page:end] = [memory] * count
+        self._read_offsets[page:end] = range(offset, offset + (count << 8), 0x100)
+        self._cpu.invalidate_rom(page << 8, end << 8)
+
+    def map_handler(self, page, read, write):
+        """
+        这一页的读写交给处理函数, 参数是完整的地址
+        """
+        if read is not None:
+            self._read_memory[page] = None
+            self._readers[page] = read
+        if write is not None:
+            self._write_memory[page] = None
+            self._writers[page] = write
+
+    def connect_to_recompiler(self, recompiler):
+        self._recompiler = recompiler
+
+    @property
+    def ram(self):
+        """
+        2KB 内部 RAM 的存储, 重编译的块直接读, 不查页表
+        """
+        return self._ram.data
+
+    def mark_code(self, address):
+        """
+        RAM 地址上有重编译过的代码, 这一页和它的镜像改成写的时候通知 recompiler
+        """
+        page = (address & 0x7FF) >> 8
+        for mirror in range(page, 0x20, 0x08):
+            self.map_handler(mirror, None, self._write_code_ram)
+
+    def connect_to_console(self, console):
+        """
+        访问 PPU 之前要让 console 把 PPU 追到 CPU 的时间
+        """
+        self._console = console
+
+    def _catch_up(self):
+        if self._console is not None:
+            self._console.catch_up()
+
+    def next_event_cycles(self):
+        """
+        PPU 下一个事件对应的 CPU 周期, 没有 console 时不知道 PPU 的时间, 返回 0
+        """
+        if self._console is None:
+            return 0
+        return self._console.next_event_cycles()
+
     def trigger_nmi(self):
-        self._cpu.handle_nmi()
+        self._cpu.trigger_nmi()
 
-    def _read(self, address):
-        if 0x8000 <= address:
-            a = address - 0x8000
-            return self._cartridge.read_byte(a)
-        elif 0x6000 <= address:
-            return self._sram.read_byte(address - 0x6000)
-        elif 0x4020 <= address:
-            raise NotImplementedError('Expansion ROM 0x4020 - 0x6000 未实现')
-        elif 0x4000 <= address:
-            # 手柄
-            if address == 0x4016:
-                d = self._joypad.read()
-                return d
-            return self._IO_registers.read_byte(address - 0x4000)
-        elif 0x2000 <= address:
-            address &= 0x2007
-            data = self._ppu.read_register(address)
-            return data
-        elif 0 <= address < 0x2000:
-            a = address & 0x7FF
-            return self._ram.read_byte(a)
+    def trigger_irq(self):
+        self._cpu.trigger_irq()
+
+    def clear_irq(self):
+        self._cpu.clear_irq()
+
+    def read_byte(self, address):
+        page = address >> 8
+        memory = self._read_memory[page]
+        if memory is None:
+            return self._readers[page](address)
+        return memory[self._read_offsets[page] + (address & 0xFF)]
+
+    def read_word(self, address):
+        # 小端, 两个字节在同一个内存页里时只查一次页表
+        page = address >> 8
+        memory = self._read_memory[page]
+        if memory is not None and (address & 0xFF) != 0xFF:
+            i = self._read_offsets[page] + (address & 0xFF)
+            return memory[i] | (memory[i + 1] << 8)
+        return self.read_byte(address) | (self.read_byte((address + 1) & 0xFFFF) << 8)
+
+    def write_byte(self, address, data):
+        page = address >> 8
+        memory = self._write_memory[page]
+        if memory is None:
+            self._writers[page](address, data)
         else:
-            a = hex(address).upper()
-            raise RuntimeError("内存越界 read at {}".format(a))
+            memory[self._write_offsets[page] + (address & 0xFF)] = data
+
+    def _read(self, address):
+        return self.read_byte(address)
 
     def _write(self, address, data):
-        if 0x8000 <= address:
-            a = hex(address).upper()
-            raise RuntimeError("Mapper 未实现 write.py at {}".format(a))
-        elif 0x6000 <= address:
-            a = address - 0x6000
-            self._sram.write_byte(a, data)
-        elif 0x4020 <= address:
-            raise NotImplementedError('Expansion ROM 0x4020 - 0x6000 未实现')
-        elif 0x4000 <= address:
-            # 手柄
-            if address == 0x4016:
-                self._joypad.write(data)
-            # DMA
-            if address == 0x4014:
-                start = data * 0x100
-                spr_ram = self._ram[start:start+256]
-                for i, e in enumerate(spr_ram):
-                    self._ppu.write_spr_ram(i, e)
-            self._IO_registers.write_byte(address - 0x4000, data)
-        elif 0x2000 <= address:
-            address &= 0x2007
-            self._ppu.write_register(address, data)
-        elif 0 <= address < 0x2000:
-            address &= 0x7FF
-            self._ram.write_byte(address, data)
+        self.write_byte(address, data)
+
+    def _read_ppu_register(self, address):
+        self._catch_up()
+        return self._ppu.read_register(address & 0x2007)
+
+    def _write_ppu_register(self, address, data):
+        self._catch_up()
+        self._ppu.write_register(address & 0x2007, data)
+
+    def _read_io(self, address):
+        if address >= 0x4020:
+            return self._read_expansion(address)
+        # 手柄
+        if address == 0x4016:
+            return self._joypad.read()
+        return self._IO_registers.read_byte(address - 0x4000)
+
+    def _write_io(self, address, data):
+        if address >= 0x4020:
+            self._write_expansion(address, data)
+            return
+        # 手柄
+        if address == 0x4016:
+            self._joypad.write(data)
+        # DMA
+        if address == 0x4014:
+            self._oam_dma(data)
+        self._IO_registers.write_byte(address - 0x4000, data)
+
+    def _oam_dma(self, page):
+        """
+        OAM DMA 把 $XX00 - $XXFF 复制到 OAM
+        源页按页表找到, 内存页一次切片, 处理函数页逐字节读
+        CPU 暂停 513 个周期, 在奇数周期开始时再加 1 个对齐的周期, 见 CPU.handle_pending
+        http://wiki.nesdev.com/w/index.php/PPU_registers#OAMDMA
+        """
+        self._catch_up()
+        memory = self._read_memory[page]
+        if memory is None:
+            read = self._readers[page]
+            address = page << 8
+            data = bytes(read(address + i) for i in range(256))
         else:
-            a = hex(address).upper()
-            raise RuntimeError("内存越界 write.py at {}".format(a))
+            offset = self._read_offsets[page]
+            data = memory[offset:offset + 256]
+        self._ppu.write_oam_dma(data)
+        self._cpu.stall(513)
+
+    def _read_expansion(self, address):
+        raise NotImplementedError('Expansion ROM 0x4020 - 0x6000 未实现')
+
+    def _write_expansion(self, address, data):
+        raise NotImplementedError('Expansion ROM 0x4020 - 0x6000 未实现')
+
+    def _write_prg(self, address, data):
+        """
+        写 mapper 的寄存器
+        可能切换 CHR、mirroring 或者改变 IRQ, 先让 PPU 追上, 写完让 CPU 回到 console 重新计算下一个事件
+        """
+        self._catch_up()
+        self._cartridge.write_register(address, data)
+        self._cpu.end_run()
+
+    def _write_code_ram(self, address, data):
+        address &= 0x7FF
+        self._ram.write_byte(address, data)
+        self._recompiler.invalidate(address)
@@ -3,73 +3,112 @@ from memory.write import MemoryWrite
 from ppu import MirroringType
 
 
+# 每种 mirroring 下 4 个 nametable ($2000 $2400 $2800 $2C00) 在 vram 里的偏移
+_NAME_TABLE_OFFSETS = {
+    MirroringType.Horizontal: (0x000, 0x000, 0x400, 0x400),
+    MirroringType.Vertical: (0x000, 0x400, 0x000, 0x400),
+    MirroringType.Four_Screen: (0x000, 0x400, 0x800, 0xC00),
+    MirroringType.Single_Screen_Lower: (0x000, 0x000, 0x000, 0x000),
+    MirroringType.Single_Screen_Upper: (0x400, 0x400, 0x400, 0x400),
+}
+
+
 class PPUBus(MemoryRead, MemoryWrite):
+    """
+    PPU 的地址空间 $0000-$3FFF, $4000 以上是镜像
+        $0000-$1FFF pattern table, 卡带的 8 个 1KB CHR 窗口
+        $2000-$2FFF nametable, $3000-$3EFF 是它的镜像
+        $3F00-$3F1F 调色板 RAM, $3F20-$3FFF 是它的镜像
+
+    查找表
+        4 个 nametable 各是 vram 的一个 1KB memoryview, 按 mirroring 预先切好, mirroring 改变时重新生成
+        调色板的 32 个地址各自对应背景或 sprite 调色板 RAM, $3F10 $3F14 $3F18 $3F1C 指向背景调色板,
+        下标都是低 4 位
+        每次访问只需要一两次下标操作
+    """
     def __init__(self, ppu, vram, cartridge, background_palette, sprite_palette):
         self._vram = vram
         self._cartridge = cartridge
-        self._background_palette = background_palette
-        self._sprite_palette = sprite_palette
+        # 卡带原地修改这个列表, 可以一直引用
+        self._chr_windows = cartridge.chr_windows
+        self._setup_palettes(background_palette, sprite_palette)
+        self.set_mirroring_type(cartridge.mirroring_type)
         self._ppu = ppu
         self._ppu.connect_to_ppu_bus(self)
+        self._ppu.connect_to_mapper(cartridge.mapper)
+        self._cartridge.connect_to_ppu_bus(self)
 
-    def _write(self, address, data):
-        address &= 0x3FFF
+    def _setup_palettes(self, background_palette, sprite_palette):
+        """
+        $3F10/$3F14/$3F18/$3F1C 是 $3F00/$3F04/$3F08/$3F0C 的镜像, 读写都落在背景调色板
+        https://wiki.nesdev.com/w/index.php/PPU_palettes
+        """
+        self._palettes = [background_palette.data] * 16 + [sprite_palette.data] * 16
+        for i in range(0x10, 0x20, 4):
+            self._palettes[i] = background_palette.data
 
+    def set_mirroring_type(self, mirroring_type):
+        """
+        重新切出 4 个 nametable, 卡带初始化和 mapper 改变 mirroring 时调用
+        """
+        self._mirroring_type = mirroring_type
+        self._name_table_offsets = _NAME_TABLE_OFFSETS[mirroring_type]
+        self._name_tables = [self._vram[offset:offset + 0x400] for offset in self._name_table_offsets]
+
+    def mark_pattern_dirty(self, address, size):
+        self._ppu.mark_pattern_dirty(address, size)
+
+    def read_byte(self, address):
+        address &= 0x3FFF
         if address < 0x2000:
-            raise NotImplementedError('ppu write address {} data {}'.format(hex(address), hex(data)))
-        elif address < 0x3000:
-            a = self._address_from_mirror_type(address) - 0x2000
-            self._vram.write_byte(a, data)
+            return self._chr_windows[address >> 10][address & 0x3FF]
         elif address < 0x3F00:
-            self._write(address-0x1000, data)
+            return self._name_tables[(address >> 10) & 0x03][address & 0x3FF]
         else:
-            address &= 0x3F1F
-
-            if address < 0x3F10:
-                self._background_palette.write_byte(address-0x3F00, data)
-            else:
-                if not (address & 0b11):
-                    address -= 0x10
-                    self._background_palette.write_byte(address-0x3F00, data)
-
-                self._sprite_palette.write_byte(address-0x3F10, data)
+            index = address & 0x1F
+            return self._palettes[index][index & 0x0F]
 
-    def _read(self, address):
-        address &= 0x3FFF                               # 映射 0x4000 - 0xFFFF 到 0x0000 - 0x3FFF
+    def write_byte(self, address, data):
+        address &= 0x3FFF
         if address < 0x2000:
-            return self._cartridge.chr_rom[address]
-        elif address < 0x3000:
-            a = self._address_from_mirror_type(address) - 0x2000
-            return self._vram.read_byte(a)
+            self._cartridge.write_chr(address, data)
         elif address < 0x3F00:
-            self._read(address-0x1000)
+            table = (address >> 10) & 0x03
+            offset = address & 0x3FF
+            self._name_tables[table][offset] = data
+            self._ppu.mark_name_table_dirty(self._name_table_offsets[table] + offset)
         else:
-            address &= 0x3F1F
-
-            if address < 0x3F10:
-                return self._background_palette.read_byte(address-0x3F00)
-            else:
-                # Addresses $3F10/$3F14/$3F18/$3F1C are mirrors of $3F00/$3F04/$3F08/$3F0C
-                # https://wiki.nesdev.com/w/index.php/PPU_palettes
-                if not (address & 0b11):
-                    address -= 0x10
-                    self._background_palette.read_byte(address-0x3F00)
-
-                return self._sprite_palette.read_byte(address-0x3F10)
-
-    def _address_from_mirror_type(self, address):
-        t = self._cartridge.mirroring_type
-        if t is MirroringType.Horizontal:
-            return (address & 0b0010_0011_1111_1111) | \
-                   (0b0000_0100_0000_0000 if address & 0b0000_1000_0000_0000 else 0)
-        elif t is MirroringType.Vertical:
-            return address & 0x27FF
-        elif t is MirroringType.Four_Screen:
-            return address
+            index = address & 0x1F
+            self._palettes[index][index & 0x0F] = data
+            self._ppu.mark_palettes_dirty()
+
+    def _read(self, address):
+        return self.read_byte(address)
+
+    def _write(self, address, data):
+        self.write_byte(address, data)
+
+    def physical_name_table(self, index):
+        """
+        第 index 个 nametable ($2000 + index * 0x400) 按 mirroring 对应 vram 里的第几个 1KB
+        """
+        return self._name_table_offsets[index] >> 10
 
     def read_name_table(self, address):
         address -= 0x2000
         return self._vram[address:address + 1024]
 
+    @property
+    def tile_rows(self):
+        """
+        pattern table 里地址 n * 16 的 tile 的第 y 行是 tile_rows[n * 8 + y], 见 Cartridge.tile_rows
+        """
+        return self._cartridge.tile_rows
+
+    @property
+    def flipped_tile_rows(self):
+        return self._cartridge.flipped_tile_rows
+
     def read_pattern_table(self, address):
-        return self._cartridge.chr_rom[address:address + 0x1000]
+        windows = self._chr_windows[address >> 10:(address >> 10) + 4]
+        return b''.join(windows)
@@ -1,11 +1,53 @@
+import mmap
+
 from ppu import MirroringType
 from memory.read import MemoryRead
+from mapper.nrom import NROM
+from mapper.mmc1 import MMC1
+from mapper.uxrom import UxROM
+from mapper.cnrom import CNROM
+from mapper.mmc3 import MMC3
+from mapper.axrom import AxROM
+
+
+# iNES 的 mapper 号 -> mapper 类
+MAPPERS = {
+    0: NROM,
+    1: MMC1,
+    2: UxROM,
+    3: CNROM,
+    4: MMC3,
+    7: AxROM,
+}
+
+# (低位平面, 高位平面) -> (8 个像素的下标, 左右翻转的下标), 所有卡带共用
+_ROWS = {}
+
+
+def _decode_row(low, high):
+    key = (low, high)
+    rows = _ROWS.get(key)
+    if rows is None:
+        row = bytes(((low >> (7 - x)) & 1) | (((high >> (7 - x)) & 1) << 1) for x in range(8))
+        rows = (row, row[::-1])
+        _ROWS[key] = rows
+    return rows
 
 
 class Cartridge(MemoryRead):
     """
     nes 文件格式
     https://zhuanlan.zhihu.com/p/34636695
+
+    文件用 mmap 只读打开, 不复制, 同一个 ROM 的多个实例共享操作系统的页缓存, 用完调用 close
+    PRG-ROM 和 CHR-ROM 是文件上的 memoryview, 没有 CHR-ROM 的卡带用 8KB 的 CHR-RAM
+
+    bank 切换
+        mapper (见 mapper 目录) 只解码寄存器, 切换都通过 map_prg map_chr set_mirroring_type
+        PRG 改 CPU 总线页表里的几项, 指向 PRG-ROM 的另一段
+        CHR 按 1KB 分成 8 个窗口, 每个窗口是 CHR 的一个 memoryview 切片,
+        切换时换掉窗口, 再用切片赋值换掉 tile_rows 里对应的 512 行, 不复制也不重新解码
+        bank 没有变化的切换直接返回
     """
     def __init__(self, file_name):
         self._file_name = file_name
@@ -27,6 +69,33 @@ class Cartridge(MemoryRead):
     def chr_rom(self):
         return self._chr_rom
 
+    @property
+    def chr_windows(self):
+        """
+        PPU 的 $0000-$1FFF 分成 8 个 1KB, 地址 a 在 chr_windows[a >> 10][a & 0x3FF]
+        """
+        return self._chr_windows
+
+    @property
+    def mapper(self):
+        return self._mapper
+
+    @property
+    def tile_rows(self):
+        """
+        预先解码的 CHR tile, PPU 地址 n * 16 的 tile 的第 y 行是 tile_rows[n * 8 + y]
+        每行是 8 个像素的 bytes, 每个像素是 2 位的下标 0 - 3
+        一共 4096 行, 对应当前映射的 8KB, 切换 bank 时原地修改, 列表本身不变
+        """
+        return self._tile_rows
+
+    @property
+    def flipped_tile_rows(self):
+        """
+        和 tile_rows 相同, 但每行左右翻转, 给水平翻转的 sprite 用
+        """
+        return self._flipped_tile_rows
+
     @property
     def prg_rom(self):
         return self._prg_rom
@@ -59,18 +128,132 @@ class Cartridge(MemoryRead):
 
     def _load_nes_file(self):
         with open(self._file_name, 'rb') as f:
-            self._file_data = list(f.read())
-            if bytearray(self._file_data[:4]) != b"NES\x1a":
-                raise RuntimeError("NES 文件格式错误!")
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # 空文件不能 mmap
+                self._mmap = None
+        self._file_data = memoryview(self._mmap if self._mmap is not None else b'')
+        if self._file_data[:4] != b"NES\x1a":
+            self._file_data.release()
+            if self._mmap is not None:
+                self._mmap.close()
+            raise RuntimeError("NES 文件格式错误!")
+
+    def close(self):
+        """
+        释放文件上的所有 memoryview, 再关闭 mmap, 之后不能再读 ROM
+        还有 memoryview 没释放时 mmap 不能关闭, 所以先释放切片, 最后释放整个文件的 view
+        """
+        if self._mmap is None or self._mmap.closed:
+            return
+        views = [self._prg_rom, self._chr_rom, self._file_data]
+        if not self._chr_ram:
+            views[:0] = self._chr_banks_1k
+        for view in views:
+            view.release()
+        self._mmap.close()
 
     def _setup_mapper(self):
-        if self._prg_banks == 1:
-            self._address_mask = 0x3FFF
-        else:
-            self._address_mask = 0xFFFF
+        self._cpu_bus = None
+        self._ppu_bus = None
+        # $8000-$FFFF 每页在 PRG-ROM 里的偏移, 还没映射的是 -1
+        self._prg_offsets = [-1] * 0x80
+        self._mapper = MAPPERS[self._mapper_number](self)
 
     def _read(self, address):
-        return self._prg_rom[address & self._address_mask]
+        offset = self._prg_offsets[(address >> 8) - 0x80]
+        return self._prg_rom[offset + (address & 0xFF)]
+
+    def connect_to_cpu_bus(self, bus):
+        """
+        mapper 按上电状态把 PRG-ROM 映射到 CPU 总线的 $8000-$FFFF
+        """
+        self._cpu_bus = bus
+        self._mapper.reset()
+
+    def connect_to_ppu_bus(self, bus):
+        self._ppu_bus = bus
+
+    def write_register(self, address, data):
+        """
+        CPU 写 $8000-$FFFF
+        """
+        self._mapper.write_register(address, data)
+
+    def trigger_irq(self):
+        self._cpu_bus.trigger_irq()
+
+    def clear_irq(self):
+        self._cpu_bus.clear_irq()
+
+    def map_prg(self, address, size, bank):
+        """
+        把 PRG-ROM 的第 bank 块 (每块 size 字节) 映射到 CPU 的 address
+        bank 超出 ROM 时取余, 负数从最后一块倒数
+        """
+        bank %= len(self._prg_rom) // size
+        first = (address >> 8) - 0x80
+        count = size >> 8
+        offsets = range(bank * size, bank * size + size, 0x100)
+        if self._prg_offsets[first:first + count] == list(offsets):
+            return
+        self._prg_offsets[first:first + count] = offsets
+        self._cpu_bus.map_rom(address >> 8, count, self._prg_rom, bank * size)
+
+    def map_chr(self, address, size, bank):
+        """
+        把 CHR 的第 bank 块 (每块 size 字节, 1KB 的整数倍) 映射到 PPU 的 address
+        bank 超出 CHR 时取余
+        """
+        bank %= len(self._chr) // size
+        first = bank * (size >> 10)
+        for i in range(size >> 10):
+            window = (address >> 10) + i
+            physical = first + i
+            if self._chr_slots[window] == physical:
+                continue
+            self._chr_slots[window] = physical
+            self._chr_windows[window] = self._chr_banks_1k[physical]
+            start = window * 512
+            source = physical * 512
+            self._tile_rows[start:start + 512] = self._all_tile_rows[source:source + 512]
+            self._flipped_tile_rows[start:start + 512] = self._all_flipped_tile_rows[source:source + 512]
+            if self._ppu_bus is not None:
+                self._ppu_bus.mark_pattern_dirty(window << 10, 0x400)
+
+    def write_chr(self, address, data):
+        """
+        PPU 写 $0000-$1FFF, 只有 CHR-RAM 能写, 同时重新解码被写的那一行
+        """
+        if not self._chr_ram:
+            return
+        physical = self._chr_slots[address >> 10]
+        offset = (physical << 10) | (address & 0x3FF)
+        chr_ram = self._chr
+        chr_ram[offset] = data
+        # tile 16 字节, 前 8 字节低位平面, 后 8 字节高位平面
+        start = offset & ~0x0F
+        y = offset & 0x07
+        row, flipped = _decode_row(chr_ram[start + y], chr_ram[start + y + 8])
+        index = (offset >> 4) * 8 + y
+        self._all_tile_rows[index] = row
+        self._all_flipped_tile_rows[index] = flipped
+        # 同一个 bank 可能映射在几个窗口
+        for window, bank in enumerate(self._chr_slots):
+            if bank == physical:
+                visible = window * 512 + (index & 0x1FF)
+                self._tile_rows[visible] = row
+                self._flipped_tile_rows[visible] = flipped
+        if self._ppu_bus is not None:
+            self._ppu_bus.mark_pattern_dirty(address, 1)
+
+    def set_mirroring_type(self, mirroring_type):
+        if mirroring_type is self._mirroring_type:
+            return
+        self._mirroring_type = mirroring_type
+        if self._ppu_bus is not None:
+            self._ppu_bus.set_mirroring_type(mirroring_type)
 
     def _read_prg_byte(self, address):
         return super().read_byte(address)
@@ -81,23 +264,54 @@ class Cartridge(MemoryRead):
     def _setup_cartridge(self):
         self._load_nes_file()
         self._data_from_nes_file()
+        self._setup_tiles()
+        self._setup_chr_windows()
         self._setup_mapper()
 
+    def _setup_tiles(self):
+        """
+        加载时把整个 CHR 每个 tile 的两个位平面一次解码成像素下标, CHR-RAM 在被写时更新
+        tile 16B 前 8B 低位 后 8B 高位
+        """
+        self._all_tile_rows = []
+        self._all_flipped_tile_rows = []
+        d = self._chr
+        for start in range(0, len(d) - 15, 16):
+            for y in range(8):
+                row, flipped = _decode_row(d[start + y], d[start + y + 8])
+                self._all_tile_rows.append(row)
+                self._all_flipped_tile_rows.append(flipped)
+
+    def _setup_chr_windows(self):
+        """
+        CHR 切成 1KB 的 memoryview, 8 个窗口先按顺序映射, 之后由 mapper 切换
+        """
+        view = memoryview(self._chr)
+        self._chr_banks_1k = [view[i:i + 0x400] for i in range(0, len(view), 0x400)]
+        count = len(self._chr_banks_1k)
+        self._chr_slots = [i % count for i in range(8)]
+        self._chr_windows = [self._chr_banks_1k[bank] for bank in self._chr_slots]
+        self._tile_rows = []
+        self._flipped_tile_rows = []
+        for bank in self._chr_slots:
+            self._tile_rows.extend(self._all_tile_rows[bank * 512:bank * 512 + 512])
+            self._flipped_tile_rows.extend(self._all_flipped_tile_rows[bank * 512:bank * 512 + 512])
+
     def _setup_mapper_type(self):
         d = self._file_data
         mapper_low = (d[6] >> 4) & 0b1111
         mapper_high = (d[7] >> 4) & 0b1111
         n = (mapper_high << 4) + mapper_low
-        if n == 0:
-            self._mapper_type = 'NROM'
-        else:
+        if n not in MAPPERS:
             self._mapper_type = 'Unknown'
             raise RuntimeError("未实现的 Mapper {}".format(n))
+        self._mapper_number = n
+        self._mapper_type = MAPPERS[n].__name__
 
     def _setup_mirror_type(self):
         d = self._file_data[6]
         if d & (1 << 3):
-            self._mirroring_type = MirroringType.FourScreen
+            self._mirroring_type = MirroringType.Four_Screen
         elif d & 1:
             self._mirroring_type = MirroringType.Vertical
         else:
@@ -108,7 +322,7 @@ class Cartridge(MemoryRead):
         ram 块数 每块为 8KB，如果为 0 ，则假设只有一个 RAM 块
         """
         d = self._file_data[8]
-        self._sram_banks = 1 if d is 0 else d
+        self._sram_banks = 1 if d == 0 else d
 
     def _setup_prg_banks(self):
         self._prg_banks = self._file_data[4]
@@ -121,10 +335,18 @@ class Cartridge(MemoryRead):
         self._has_trainer = True if self._file_data[6] & 4 else False
 
     def _setup_rom(self):
+        """
+        16 字节的文件头之后是可选的 512 字节 trainer, 然后是 PRG-ROM 和 CHR-ROM
+        """
         d = self._file_data
+        start = 16 + (512 if self._has_trainer else 0)
         prg_size = 16 * 1024 * self.prg_banks
-        self._prg_rom = d[16:prg_size + 16]
-        self._chr_rom = d[16 + prg_size:]
+        chr_size = 8 * 1024 * self.chr_banks
+        self._prg_rom = d[start:start + prg_size]
+        self._chr_rom = d[start + prg_size:start + prg_size + chr_size]
+        # 没有 CHR-ROM 时用 8KB CHR-RAM
+        self._chr_ram = chr_size == 0
+        self._chr = bytearray(0x2000) if self._chr_ram else self._chr_rom
 
     def _data_from_nes_file(self):
         self._setup_mirror_type()
@@ -0,0 +1,488 @@
+"""
+生成 CPU 指令处理函数
+
+每个 opcode 生成一个函数, 寻址模式和指令操作拼在同一个函数里,
+基础周期直接写成返回值, 只有跨页和分支跳转才在运行时加周期
+
+生成的函数签名是 handler(cpu, operand), 返回这条指令消耗的 CPU 周期
+operand 是 CPU 预先解码好的操作数, 见 operand_kinds
+
+模板里的占位符
+    {byte} {word} {offset}  指令的操作数, 处理函数里是参数 operand, 重编译时是常量
+    {value}                 读操作数的值, 立即数寻址就是 {byte}
+    {next}                  下一条指令的地址
+    {cycles}                指令消耗的周期
+
+N Z 标志延迟计算, ADC SBC 和移位查表, 见 alu
+"""
+from alu import TABLES
+
+
+# 寻址模式
+# 计算出 address (分支指令是 offset), 可能跨页的模式会给 cycles 加 1
+_ADDRESSING = {
+    'imp': [],
+    'imm': [],
+    'zp': [
+        'address = {byte}',
+    ],
+    'zp_x': [
+        'address = ({byte} + cpu._register_x) & 0xFF',
+    ],
+    'zp_y': [
+        'address = ({byte} + cpu._register_y) & 0xFF',
+    ],
+    'rel': [
+        'offset = {offset}',
+    ],
+    'abs': [
+        'address = {word}',
+    ],
+    'abs_x': [
+        'base = {word}',
+        'address = (base + cpu._register_x) & 0xFFFF',
+        'if (base ^ address) & 0xFF00:',
+        '    cycles += 1',
+    ],
+    # 写的时候总是增加一个周期, 生成时加到基础周期里
+    'abs_x_write': [
+        'address = ({word} + cpu._register_x) & 0xFFFF',
+    ],
+    'abs_y': [
+        'base = {word}',
+        'address = (base + cpu._register_y) & 0xFFFF',
+        'if (base ^ address) & 0xFF00:',
+        '    cycles += 1',
+    ],
+    'abs_y_write': [
+        'address = ({word} + cpu._register_y) & 0xFFFF',
+    ],
+    # 6502 的 bug, 指针在页尾时高字节从当前页的开头读
+    'ind': [
+        'pointer = {word}',
+        'if pointer & 0xFF == 0xFF:',
+        '    high = pointer & 0xFF00',
+        'else:',
+        '    high = pointer + 1',
+        'address = read_byte(pointer) | (read_byte(high) << 8)',
+    ],
+    'inx': [
+        'pointer = ({byte} + cpu._register_x) & 0xFF',
+        'address = read_byte(pointer) | (read_byte((pointer + 1) & 0xFF) << 8)',
+    ],
+    'iny': [
+        'pointer = {byte}',
+        'base = read_byte(pointer) | (read_byte((pointer + 1) & 0xFF) << 8)',
+        'address = (base + cpu._register_y) & 0xFFFF',
+        'if (base ^ address) & 0xFF00:',
+        '    cycles += 1',
+    ],
+}
+
+# 运行时可能增加周期的寻址模式
+_PAGE_PENALTY = ('abs_x', 'abs_y', 'iny')
+# 总是增加一个周期的寻址模式
+_WRITE_PENALTY = ('abs_x_write', 'abs_y_write')
+
+# 处理函数的操作数由调用者解码好传进来
+_HANDLER_OPERANDS = {
+    'byte': 'operand',
+    'word': 'operand',
+    'offset': 'operand',
+}
+
+# 寻址模式对应的操作数
+#   byte    指令后面的 1 个字节
+#   word    指令后面的 2 个字节, 小端
+#   offset  有符号的 1 个字节, 分支指令的偏移
+_OPERAND_KINDS = {
+    'imp': None,
+    'imm': 'byte',
+    'zp': 'byte',
+    'zp_x': 'byte',
+    'zp_y': 'byte',
+    'inx': 'byte',
+    'iny': 'byte',
+    'rel': 'offset',
+    'abs': 'word',
+    'abs_x': 'word',
+    'abs_x_write': 'word',
+    'abs_y': 'word',
+    'abs_y_write': 'word',
+    'ind': 'word',
+}
+
+
+def _nz(value):
+    # N Z 延迟计算, 见 alu
+    return [
+        'cpu._nz = {}'.format(value),
+    ]
+
+
+def _load(register):
+    return [
+        'value = {value}',
+        'cpu.{} = value'.format(register),
+    ] + _nz('value')
+
+
+def _store(register):
+    return [
+        'write_byte(address, cpu.{})'.format(register),
+    ]
+
+
+def _transfer(source, target):
+    return [
+        'value = cpu.{}'.format(source),
+        'cpu.{} = value'.format(target),
+    ] + _nz('value')
+
+
+def _step(register, delta):
+    return [
+        'value = (cpu.{} {}) & 0xFF'.format(register, delta),
+        'cpu.{} = value'.format(register),
+    ] + _nz('value')
+
+
+def _modify(delta):
+    return [
+        'value = (read_byte(address) {}) & 0xFF'.format(delta),
+        'write_byte(address, value)',
+    ] + _nz('value')
+
+
+def _logic(operator):
+    return [
+        'value = cpu._accumulator {} {{value}}'.format(operator),
+        'cpu._accumulator = value',
+    ] + _nz('value')
+
+
+def _compare(register):
+    return [
+        'result = cpu.{} - {{value}}'.format(register),
+        'cpu._flag_c = 1 if result >= 0 else 0',
+        'cpu._nz = result & 0xFF',
+    ]
+
+
+def _add(value):
+    return [
+        'entry = adc_table[(cpu._flag_c << 16) | (cpu._accumulator << 8) | {}]'.format(value),
+        'result = entry & 0xFF',
+        'cpu._accumulator = result',
+        'cpu._flag_c = (entry >> 8) & 1',
+        'cpu._flag_v = entry >> 9',
+    ] + _nz('result')
+
+
+def _flag(name, value):
+    return [
+        'cpu.{} = {}'.format(name, value),
+    ]
+
+
+def _pull_flags():
+    return [
+        'cpu._flag_c = value & 1',
+        'cpu._flag_i = (value >> 2) & 1',
+        'cpu._flag_d = (value >> 3) & 1',
+        'cpu._flag_v = (value >> 6) & 1',
+        'cpu._nz = ((value & 0x80) << 8) | (((value >> 1) & 1) ^ 1)',
+    ]
+
+
+# 移位指令, 查表得到 entry = 结果 | C << 8
+_SHIFT = {
+    'asl': 'entry = asl_table[value]',
+    'lsr': 'entry = lsr_table[value]',
+    'rol': 'entry = rol_table[(cpu._flag_c << 8) | value]',
+    'ror': 'entry = ror_table[(cpu._flag_c << 8) | value]',
+}
+
+_SHIFT_ACCUMULATOR = [
+    'value = cpu._accumulator',
+    '{shift}',
+    'result = entry & 0xFF',
+    'cpu._flag_c = entry >> 8',
+    'cpu._accumulator = result',
+] + _nz('result')
+
+_SHIFT_MEMORY = [
+    'value = read_byte(address)',
+    '{shift}',
+    'result = entry & 0xFF',
+    'cpu._flag_c = entry >> 8',
+    'write_byte(address, result)',
+] + _nz('result')
+
+# 分支条件
+_BRANCH = {
+    'bpl': 'not cpu._nz & 0x8080',
+    'bmi': 'cpu._nz & 0x8080',
+    'bvc': 'cpu._flag_v == 0',
+    'bvs': 'cpu._flag_v == 1',
+    'bcc': 'cpu._flag_c == 0',
+    'bcs': 'cpu._flag_c == 1',
+    'bne': 'cpu._nz & 0xFF',
+    'beq': 'not cpu._nz & 0xFF',
+}
+
+# 指令操作, 执行前 pc 已经指向下一条指令
+_OPERATIONS = {
+    'lda': _load('_accumulator'),
+    'ldx': _load('_register_x'),
+    'ldy': _load('_register_y'),
+    'sta': _store('_accumulator'),
+    'stx': _store('_register_x'),
+    'sty': _store('_register_y'),
+    'tax': _transfer('_accumulator', '_register_x'),
+    'tay': _transfer('_accumulator', '_register_y'),
+    'txa': _transfer('_register_x', '_accumulator'),
+    'tya': _transfer('_register_y', '_accumulator'),
+    'tsx': _transfer('_stack_pointer', '_register_x'),
+    'txs': [
+        'cpu._stack_pointer = cpu._register_x',
+    ],
+    'inx': _step('_register_x', '+ 1'),
+    'iny': _step('_register_y', '+ 1'),
+    'dex': _step('_register_x', '- 1'),
+    'dey': _step('_register_y', '- 1'),
+    'inc': _modify('+ 1'),
+    'dec': _modify('- 1'),
+    'and': _logic('&'),
+    'ora': _logic('|'),
+    'eor': _logic('^'),
+    'cmp': _compare('_accumulator'),
+    'cpx': _compare('_register_x'),
+    'cpy': _compare('_register_y'),
+    'adc': _add('{value}'),
+    # A - M - (1 - C) = A + (M ^ 0xFF) + C
+    'sbc': _add('{value} ^ 0xFF'),
+    'bit': [
+        'value = {value}',
+        'cpu._flag_v = (value >> 6) & 1',
+        'cpu._nz = (cpu._accumulator & value) | ((value & 0x80) << 8)',
+    ],
+    'sec': _flag('_flag_c', 1),
+    'clc': _flag('_flag_c', 0),
+    'sei': _flag('_flag_i', 1),
+    'cli': _flag('_flag_i', 0),
+    'sed': _flag('_flag_d', 1),
+    'cld': _flag('_flag_d', 0),
+    'clv': _flag('_flag_v', 0),
+    'nop': [],
+    'pha': [
+        'sp = cpu._stack_pointer',
+        'write_byte(0x100 + sp, cpu._accumulator)',
+        'cpu._stack_pointer = (sp - 1) & 0xFF',
+    ],
+    'php': [
+        'sp = cpu._stack_pointer',
+        'write_byte(0x100 + sp, cpu.status | 0b00010000)',
+        'cpu._stack_pointer = (sp - 1) & 0xFF',
+    ],
+    'pla': [
+        'sp = (cpu._stack_pointer + 1) & 0xFF',
+        'cpu._stack_pointer = sp',
+        'value = read_byte(0x100 + sp)',
+        'cpu._accumulator = value',
+    ] + _nz('value'),
+    'plp': [
+        'sp = (cpu._stack_pointer + 1) & 0xFF',
+        'cpu._stack_pointer = sp',
+        'value = read_byte(0x100 + sp)',
+    ] + _pull_flags(),
+}
+
+# 自己设置 pc 的指令, {next} 是下一条指令的地址
+_CONTROL_FLOW = {
+    'jmp': [
+        'cpu._program_counter = address',
+    ],
+    'jsr': [
+        'sp = cpu._stack_pointer',
+        'write_byte(0x100 + sp, (({next} - 1) >> 8) & 0xFF)',
+        'write_byte(0x100 + ((sp - 1) & 0xFF), ({next} - 1) & 0xFF)',
+        'cpu._stack_pointer = (sp - 2) & 0xFF',
+        'cpu._program_counter = address',
+    ],
+    'rts': [
+        'sp = cpu._stack_pointer',
+        'low = read_byte(0x100 + ((sp + 1) & 0xFF))',
+        'high = read_byte(0x100 + ((sp + 2) & 0xFF))',
+        'cpu._stack_pointer = (sp + 2) & 0xFF',
+        'cpu._program_counter = (high << 8) + low + 1',
+    ],
+    'rti': [
+        'sp = cpu._stack_pointer',
+        'value = read_byte(0x100 + ((sp + 1) & 0xFF))',
+    ] + _pull_flags() + [
+        'low = read_byte(0x100 + ((sp + 2) & 0xFF))',
+        'high = read_byte(0x100 + ((sp + 3) & 0xFF))',
+        'cpu._stack_pointer = (sp + 3) & 0xFF',
+        'cpu._program_counter = (high << 8) + low',
+    ],
+    # IRQ interrupt vector at $FFFE/F
+    'brk': [
+        'if cpu._flag_i == 1:',
+        '    cpu._program_counter = {next}',
+        'else:',
+        '    sp = cpu._stack_pointer',
+        '    write_byte(0x100 + sp, ({next} >> 8) & 0xFF)',
+        '    write_byte(0x100 + ((sp - 1) & 0xFF), {next} & 0xFF)',
+        '    write_byte(0x100 + ((sp - 2) & 0xFF), cpu.status | 0b00010000)',
+        '    cpu._stack_pointer = (sp - 3) & 0xFF',
+        '    cpu._flag_b = 1',
+        '    cpu._program_counter = read_word(0xFFFE)',
+    ],
+}
+
+for _name, _condition in _BRANCH.items():
+    _CONTROL_FLOW[_name] = [
+        'if {}:'.format(_condition),
+        '    cycles += 1',
+        '    target = {next} + offset',
+        '    if (target ^ {next}) & 0xFF00:',
+        '        cycles += 1',
+        '    cpu._program_counter = target',
+        'else:',
+        '    cpu._program_counter = {next}',
+    ]
+
+
+def _instruction_name(execute):
+    return execute.__name__[1:]
+
+
+def _addressing_name(fetch_operand):
+    return fetch_operand.__name__[len('_address_'):]
+
+
+def _operation_lines(name, mode):
+    if name in _SHIFT:
+        if mode == 'imp':
+            template = _SHIFT_ACCUMULATOR
+        else:
+            template = _SHIFT_MEMORY
+        lines = []
+        for line in template:
+            if line == '{shift}':
+                lines.append(_SHIFT[name])
+            else:
+                lines.append(line)
+        return lines
+    else:
+        return _OPERATIONS[name]
+
+
+def describe(instruction):
+    """
+    :return: 指令名, 寻址模式, 指令长度, 基础周期
+    """
+    execute, fetch_operand, _, _, length, cycles = instruction
+    mode = _addressing_name(fetch_operand)
+    if mode in _WRITE_PENALTY:
+        cycles += 1
+    return _instruction_name(execute), mode, length, cycles
+
+
+def is_control_flow(name):
+    return name in _CONTROL_FLOW
+
+
+def has_penalty(name, mode):
+    """
+    运行时是否可能增加周期
+    """
+    return mode in _PAGE_PENALTY or name in _BRANCH
+
+
+def operand_kinds(instruction_set):
+    """
+    :return: 256 项的列表, 每个 opcode 的操作数类型, 未知的 opcode 是 None
+    """
+    kinds = [None] * 256
+    for opcode, instruction in instruction_set.items():
+        _, mode, _, _ = describe(instruction)
+        kinds[opcode] = _OPERAND_KINDS[mode]
+    return kinds
+
+
+def instruction_lines(name, mode, operands, next_pc, cycles):
+    """
+    生成一条指令的寻址和操作代码
+    控制流指令自己设置 cpu._program_counter, 其他指令由调用者设置
+
+    :param operands: {byte} {word} {offset} 对应的表达式
+    """
+    keys = dict(operands)
+    keys['value'] = operands['byte'] if mode == 'imm' else 'read_byte(address)'
+    keys['next'] = next_pc
+    keys['cycles'] = cycles
+    if name in _CONTROL_FLOW:
+        operation = _CONTROL_FLOW[name]
+    else:
+        operation = _operation_lines(name, mode)
+    return [line.format(**keys) for line in _ADDRESSING[mode] + operation]
+
+
+def handler_source(opcode, instruction):
+    """
+    生成单个 opcode 的处理函数源码
+    """
+    name, mode, length, cycles = describe(instruction)
+    dynamic = has_penalty(name, mode)
+    cycles_name = 'cycles' if dynamic else str(cycles)
+    next_pc = 'pc + {}'.format(length)
+
+    body = ['pc = cpu._program_counter']
+    if dynamic:
+        body.append('cycles = {}'.format(cycles))
+    lines = instruction_lines(name, mode, _HANDLER_OPERANDS, next_pc, cycles_name)
+    if is_control_flow(name):
+        body.extend(lines)
+    else:
+        # 寻址之后再更新 pc, 和 _address_xxx 的顺序一致
+        address_lines = len(_ADDRESSING[mode])
+        body.extend(lines[:address_lines])
+        body.append('cpu._program_counter = {}'.format(next_pc))
+        body.extend(lines[address_lines:])
+    body.append('return {}'.format(cycles_name))
+
+    source = ['def op_{:02x}(cpu, operand):'.format(opcode)]
+    source.extend('    ' + line for line in body)
+    return source
+
+
+def handlers_source(instruction_set):
+    """
+    生成整张 256 项处理函数表的源码
+    处理函数是 _build 里的闭包, 读写总线的函数和查找表都是自由变量, 访问比全局变量快
+    """
+    source = ['def _build(read_byte, write_byte, read_word, {}):'.format(', '.join(TABLES))]
+    for opcode in sorted(instruction_set):
+        source.extend('    ' + line for line in handler_source(opcode, instruction_set[opcode]))
+    source.extend([
+        '    def unknown(cpu, operand):',
+        '        pc = cpu._program_counter',
+        '        raise RuntimeError("未知的 opcode {} at {}".format(hex(read_byte(pc)), hex(pc)))',
+        '    handlers = [unknown] * 256',
+    ])
+    for opcode in sorted(instruction_set):
+        source.append('    handlers[0x{0:02X}] = op_{0:02x}'.format(opcode))
+    source.append('    return handlers')
+    return '\n'.join(source) + '\n'
+
+
+def build_handlers(instruction_set, bus):
+    """
+    根据 CPU 指令集和总线生成 256 项的处理函数列表
+    """
+    namespace = {}
+    code = compile(handlers_source(instruction_set), '<cpu handlers>', 'exec')
+    exec(code, namespace)
+    return namespace['_build'](bus.read_byte, bus.write_byte, bus.read_word, **TABLES)
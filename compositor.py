@@ -0,0 +1,91 @@
+"""
+帧合成
+
+PPU 画出三张 256 * 240 的平面, 都是 bytearray
+    background  背景的调色板下标 0 - 15, 0 是透明
+    sprites     sprite 的调色板下标 16 - 31, 0 是没有 sprite
+    priority    1 表示这个 sprite 像素在背景后面
+合成时 sprite 像素不透明, 并且不在不透明的背景后面, 就显示 sprite, 否则显示背景
+最后按调色板 RAM 换算成 NES 颜色下标 0 - 63, 输出 256 * 240 的 bytearray
+一帧中间改过调色板时, 每段扫描线用各自的颜色表换算
+
+python  纯 Python, 只处理有 sprite 的扫描线
+numpy   用 NumPy 数组运算合成整帧, 需要安装 numpy
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _line_ranges(line_colors):
+    """
+    :return: 每段的 (第一条扫描线, 结束的扫描线, 颜色表)
+    """
+    for index, (first, colors) in enumerate(line_colors):
+        last = line_colors[index + 1][0] if index + 1 < len(line_colors) else 240
+        yield first, last, colors
+
+
+class Compositor:
+    def __init__(self, background, sprites, priority):
+        self._background = background
+        self._sprites = sprites
+        self._priority = priority
+
+    def compose(self, line_colors, sprite_lines):
+        """
+        :param line_colors: [(开始的扫描线, 颜色表)], 按扫描线排序, 第一项从第 0 条开始,
+            颜色表是 256 字节的 bytes.translate 表, 前 32 项是调色板 RAM 对应的 NES 颜色下标
+        :param sprite_lines: 有 sprite 像素的扫描线
+        """
+        background = self._background
+        sprites = self._sprites
+        priority = self._priority
+        frame = bytearray(background)
+        for line in sprite_lines:
+            start = line * 256
+            for i in range(start, start + 256):
+                s = sprites[i]
+                if s and not (priority[i] and background[i]):
+                    frame[i] = s
+        if len(line_colors) == 1:
+            return frame.translate(line_colors[0][1])
+        for first, last, colors in _line_ranges(line_colors):
+            frame[first * 256:last * 256] = frame[first * 256:last * 256].translate(colors)
+        return frame
+
+
+class NumpyCompositor(Compositor):
+    def __init__(self, background, sprites, priority):
+        super().__init__(background, sprites, priority)
+        # 直接引用 PPU 的 bytearray, 不复制
+        shape = (240, 256)
+        self._background = numpy.frombuffer(background, dtype=numpy.uint8).reshape(shape)
+        self._sprites = numpy.frombuffer(sprites, dtype=numpy.uint8).reshape(shape)
+        self._priority = numpy.frombuffer(priority, dtype=numpy.uint8).reshape(shape)
+
+    def compose(self, line_colors, sprite_lines):
+        background = self._background
+        sprites = self._sprites
+        shown = (sprites != 0) & ((self._priority == 0) | (background == 0))
+        frame = numpy.where(shown, sprites, background)
+        output = numpy.empty_like(frame)
+        for first, last, colors in _line_ranges(line_colors):
+            table = numpy.frombuffer(colors, dtype=numpy.uint8)
+            output[first:last] = table[frame[first:last]]
+        return bytearray(output.tobytes())
+
+
+BACKENDS = {
+    'python': Compositor,
+    'numpy': NumpyCompositor,
+}
+
+
+def create_compositor(backend, background, sprites, priority):
+    if backend not in BACKENDS:
+        raise RuntimeError("未知的合成方式 {}".format(backend))
+    if backend == 'numpy' and numpy is None:
+        raise RuntimeError("合成方式 numpy 需要安装 numpy")
+    return BACKENDS[backend](background, sprites, priority)
@@ -0,0 +1,124 @@
+from cpu import CPU
+from ppu import PPU
+from joypad import Joypad
+from memory.ram import RAM
+from bus.cpu_bus import CPUBus
+from bus.ppu_bus import PPUBus
+from cartridge import Cartridge
+
+
+class Console:
+    """
+    NES 主机, 只包含 CPU PPU 总线和卡带, 不依赖窗口
+
+    Catch-up
+    http://wiki.nesdev.com/w/index.php/Catch-up
+        主时钟是 CPU 周期 (cpu.cycles), 1 个 CPU 周期对应 3 个 PPU 周期
+        CPU 连续执行, PPU 只在下面几种情况下一次追上 CPU 的时间
+            CPU 读写 $2000-$3FFF 的 PPU 寄存器
+            OAM DMA
+            写 mapper 的寄存器, 之后 CPU 结束这一段, 重新计算下一个事件
+            到了 PPU 的下一个事件 (vblank, pre-render, mapper 的 IRQ, 帧结束), NMI 和 IRQ 也在这时候产生
+
+    空转循环
+        idle_skip 打开时 CPU 在等待循环里直接跳到下一个事件, skipped_cycles 是上一帧跳过的周期
+
+    帧合成
+        compositor 是 'python' 或者 'numpy', 见 compositor.py
+    """
+    def __init__(self, rom_path, dispatch='generated', idle_skip=True, compositor='python'):
+        self._rom_path = rom_path
+        self._cartridge = Cartridge(self._rom_path)
+        self._setup_cpu_bus(dispatch, idle_skip, compositor)
+        self._setup_ppu_bus()
+        # PPU 已经执行到的 PPU 周期
+        self._ppu_cycles = 0
+        # 上一帧空转跳过的 CPU 周期
+        self._skipped_cycles = 0
+
+        self._cpu.reset()
+
+    @property
+    def cpu(self):
+        return self._cpu
+
+    @property
+    def ppu(self):
+        return self._ppu
+
+    @property
+    def joypad(self):
+        return self._joypad
+
+    @property
+    def cartridge(self):
+        return self._cartridge
+
+    @property
+    def skipped_cycles(self):
+        return self._skipped_cycles
+
+    def _setup_cpu_bus(self, dispatch, idle_skip, compositor):
+        size = self._cartridge.sram_bank * 8 * 1024
+        sram = RAM(size)
+        ram = RAM(0x0800)
+        self._joypad = Joypad()
+        IO_registers = RAM(0x20)
+        self._ppu = PPU(compositor)
+        self._cpu = CPU(dispatch, idle_skip)
+        self._cpu_bus = CPUBus(self._cpu, self._ppu, ram, sram, self._cartridge, self._joypad, IO_registers)
+        self._cpu_bus.connect_to_console(self)
+
+    def _setup_ppu_bus(self):
+        vram = RAM(0x1000)  # 4K
+        background_palette = RAM(16)
+        sprite_palette = RAM(16)
+        self._ppu_bus = PPUBus(self._ppu, vram, self._cartridge, background_palette, sprite_palette)
+
+    def close(self):
+        """
+        关闭卡带的 ROM 文件, 之后不能再运行
+        """
+        self._cartridge.close()
+
+    def catch_up(self):
+        """
+        PPU 追上 CPU 当前的时间
+        """
+        dots = self._cpu.cycles * 3 - self._ppu_cycles
+        if dots > 0:
+            self._ppu.run(dots)
+            self._ppu_cycles += dots
+
+    def next_event_cycles(self):
+        """
+        PPU 下一个事件对应的 CPU 周期, CPU 在这之前访问 PPU 看到的都是事件之前的状态
+        """
+        event = self._ppu_cycles + self._ppu.dots_until_event()
+        return (event + 2) // 3
+
+    def step(self):
+        """
+        CPU 执行一条指令, PPU 追上
+        """
+        self._cpu.run(1)
+        self.catch_up()
+
+    def run_until_event(self):
+        """
+        CPU 一直执行到 PPU 的下一个事件, 再让 PPU 追上
+        """
+        dots = self._ppu.dots_until_event() - (self._cpu.cycles * 3 - self._ppu_cycles)
+        if dots > 0:
+            self._cpu.run((dots + 2) // 3)
+        self.catch_up()
+
+    def run_frame(self):
+        """
+        运行到 PPU 完成当前这一帧
+        """
+        frame = self._ppu.frame
+        skipped = self._cpu.idle_cycles
+        while self._ppu.frame == frame:
+            self.run_until_event()
+        self._skipped_cycles = self._cpu.idle_cycles - skipped
@@ -0,0 +1,311 @@
+"""
+模拟核心的运行循环
+
+可以在 Emulator 的线程里运行, 也可以用 CoreProcess 放到子进程里, 不和窗口争 GIL
+子进程和窗口进程通过一块共享内存交换画面和手柄状态
+
+共享内存布局
+    0           最新一帧所在的缓冲区 0 / 1
+    1           运行标志, 窗口进程改成 0 让子进程退出
+    2           手柄状态, 第 0 - 7 位是 a b select start up down left right
+    4 - 7       已经完成的帧数, uint32 little endian
+    8 - 9       两个缓冲区的 emphasis
+    12 - 15     速度倍数, float32, 0 表示不限速
+    16 -        两个 256 * 240 的缓冲区, 内容和 PPU.frame_buffer 相同
+
+双缓冲
+    子进程把新的一帧写进不是最新的那个缓冲区, 写完再改最新的下标, 最后增加帧数, 再设置 event
+    窗口进程等 event, 先读帧数, 再按最新的下标复制缓冲区, 复制完帧数没变就说明这个缓冲区没有被改写, 否则重新复制
+
+FrameHandoff 和 CoreProcess 都有 next_frame(timeout) 和 dropped_frames, 窗口不用关心核心在哪里运行
+"""
+import struct
+import time
+import threading
+from collections import deque
+from multiprocessing import Event, Process, shared_memory
+
+from console import Console
+
+
+# NTSC 的帧率
+NTSC_FPS = 60.0988
+# 自动跳帧时最多连续跳过的帧数
+MAX_AUTO_FRAMESKIP = 4
+# 速度倍数, None 是不限速
+TURBO_SPEED = 3.0
+SLOW_SPEED = 0.5
+# 落后真实时间超过这么多秒就重新开始计时, 不去追赶
+MAX_LAG = 0.25
+
+FRAME_SIZE = 256 * 240
+_LATEST = 0
+_RUNNING = 1
+_JOYPAD = 2
+_FRAMES = 4
+_EMPHASIS = 8
+_SPEED = 12
+_BUFFERS = 16
+SHARED_SIZE = _BUFFERS + 2 * FRAME_SIZE
+
+
+class FramePacer:
+    """
+    按 NTSC_FPS * speed 控制模拟的速度
+        每一帧的目标时间都从起点按帧数算出来, 而不是每帧睡一段固定的时间, 睡眠的误差不会累积
+        落后超过 MAX_LAG 秒 (比如机器卡了一下) 就从现在重新计时, 不会为了追上而全速运行一段
+        speed 是 None 时不限速
+    """
+    def __init__(self, speed=1.0):
+        self._speed = speed
+        self._restart()
+
+    def _restart(self):
+        self._start = time.perf_counter()
+        self._frames = 0
+
+    @property
+    def speed(self):
+        return self._speed
+
+    @speed.setter
+    def speed(self, speed):
+        if speed != self._speed:
+            self._speed = speed
+            self._restart()
+
+    def _deadline(self):
+        return self._start + self._frames / (NTSC_FPS * self._speed)
+
+    def behind(self):
+        """
+        已经运行的帧落后于真实时间
+        """
+        return self._speed is not None and time.perf_counter() > self._deadline()
+
+    def wait(self):
+        """
+        每运行完一帧调用, 睡到这一帧应该结束的时间
+        """
+        self._frames += 1
+        if self._speed is None:
+            return
+        delay = self._deadline() - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -MAX_LAG:
+            self._restart()
+
+
+def run_console(console, frameskip=0, on_frame=None, running=None, pacer=None):
+    """
+    一直运行 console
+
+    :param frameskip: 每画一帧之后跳过的帧数, 'auto' 表示比真实时间慢的时候自动跳过
+    :param on_frame: 每画出一帧调用 on_frame(ppu), 这时 frame_ready 会被清掉
+    :param running: 每帧开始前调用, 返回 False 时停止
+    :param pacer: FramePacer, 没有时不限速
+    """
+    ppu = console.ppu
+    auto = frameskip == 'auto'
+    if not auto:
+        ppu.frameskip = frameskip
+    start = time.perf_counter()
+    first = ppu.frame
+    while running is None or running():
+        console.run_frame()
+        if on_frame is not None and ppu.frame_ready:
+            ppu.frame_ready = False
+            on_frame(ppu)
+        if auto:
+            if pacer is not None:
+                behind = pacer.behind()
+            else:
+                behind = time.perf_counter() - start > (ppu.frame - first) / NTSC_FPS
+            ppu.skip_next_frame = behind and ppu.skipped_frames < MAX_AUTO_FRAMESKIP
+        if pacer is not None:
+            pacer.wait()
+
+
+class FrameHandoff:
+    """
+    同一个进程里从模拟线程把画面交给显示线程, 不用锁
+        PPU 每帧合成时生成新的 frame_buffer, 交出去之后不会再被修改, 所以显示的画面不会撕裂
+        只保留最新的一帧, deque 的 append 和 popleft 都是原子操作, 新的一帧直接挤掉没来得及显示的
+        每帧带着序号, 显示线程按序号的间隔统计丢掉的帧, 跳帧没画的帧不算
+    """
+    def __init__(self):
+        self._frames = deque(maxlen=1)
+        self._ready = threading.Event()
+        # 交出的帧数, 只有模拟线程修改
+        self._published = 0
+        # 取走的最后一帧的序号
+        self._number = 0
+        self._dropped = 0
+
+    @property
+    def dropped_frames(self):
+        return self._dropped
+
+    def publish(self, ppu):
+        """
+        模拟线程每画出一帧调用
+        """
+        self._published += 1
+        self._frames.append((self._published, ppu.frame_buffer, ppu.emphasis))
+        self._ready.set()
+
+    def next_frame(self, timeout=None):
+        """
+        最多等 timeout 秒
+
+        :return: 有新的一帧返回 (画面, emphasis), 否则返回 None
+        """
+        if not self._ready.wait(timeout):
+            return None
+        # 先清掉再取, 取之后交过来的帧会重新设置 event
+        self._ready.clear()
+        try:
+            number, frame, emphasis = self._frames.popleft()
+        except IndexError:
+            return None
+        self._dropped += number - self._number - 1
+        self._number = number
+        return frame, emphasis
+
+
+class SharedKey:
+    """
+    和 joypad.Key 一样的接口, 按键改的是共享内存里手柄状态的一位
+    """
+    def __init__(self, buffer, bit):
+        self._buffer = buffer
+        self._mask = 1 << bit
+
+    def key_down(self):
+        self._buffer[_JOYPAD] |= self._mask
+
+    def key_up(self):
+        self._buffer[_JOYPAD] &= ~self._mask & 0xFF
+
+
+class SharedJoypad:
+    def __init__(self, buffer):
+        self.a = SharedKey(buffer, 0)
+        self.b = SharedKey(buffer, 1)
+        self.select = SharedKey(buffer, 2)
+        self.start = SharedKey(buffer, 3)
+        self.up = SharedKey(buffer, 4)
+        self.down = SharedKey(buffer, 5)
+        self.left = SharedKey(buffer, 6)
+        self.right = SharedKey(buffer, 7)
+
+
+def _publish_frame(buffer, ppu, frames):
+    back = buffer[_LATEST] ^ 1
+    start = _BUFFERS + back * FRAME_SIZE
+    buffer[start:start + FRAME_SIZE] = ppu.frame_buffer
+    buffer[_EMPHASIS + back] = ppu.emphasis
+    buffer[_LATEST] = back
+    struct.pack_into('<I', buffer, _FRAMES, frames)
+
+
+def _read_speed(buffer):
+    speed = struct.unpack_from('<f', buffer, _SPEED)[0]
+    return speed if speed > 0 else None
+
+
+def _write_speed(buffer, speed):
+    struct.pack_into('<f', buffer, _SPEED, speed or 0)
+
+
+def _core_main(name, ready, rom_path, frameskip):
+    """
+    子进程的入口
+    """
+    memory = shared_memory.SharedMemory(name=name)
+    buffer = memory.buf
+    console = Console(rom_path)
+    joypad = console.joypad
+    pacer = FramePacer(_read_speed(buffer))
+    frames = 0
+
+    def running():
+        # 手柄状态和速度每帧同步一次, 游戏也是每帧读一次手柄
+        joypad.update(buffer[_JOYPAD])
+        pacer.speed = _read_speed(buffer)
+        return buffer[_RUNNING] == 1
+
+    def on_frame(ppu):
+        nonlocal frames
+        frames += 1
+        _publish_frame(buffer, ppu, frames)
+        ready.set()
+
+    try:
+        run_console(console, frameskip, on_frame, running, pacer)
+    finally:
+        console.close()
+        memory.close()
+
+
+class CoreProcess:
+    """
+    在子进程里运行模拟核心, 窗口进程只负责显示画面和把按键写进共享内存
+    """
+    def __init__(self, rom_path, frameskip=0, speed=1.0):
+        self._memory = shared_memory.SharedMemory(create=True, size=SHARED_SIZE)
+        self._memory.buf[_RUNNING] = 1
+        _write_speed(self._memory.buf, speed)
+        self.joypad = SharedJoypad(self._memory.buf)
+        self._ready = Event()
+        self._process = Process(
+            target=_core_main, args=(self._memory.name, self._ready, rom_path, frameskip), daemon=True)
+        # 已经取走的帧数
+        self._frames = 0
+        self._dropped = 0
+
+    @property
+    def dropped_frames(self):
+        return self._dropped
+
+    @property
+    def speed(self):
+        return _read_speed(self._memory.buf)
+
+    @speed.setter
+    def speed(self, speed):
+        _write_speed(self._memory.buf, speed)
+
+    def start(self):
+        self._process.start()
+
+    def stop(self):
+        self._memory.buf[_RUNNING] = 0
+        self._process.join()
+        self.joypad = None
+        self._memory.close()
+        self._memory.unlink()
+
+    def next_frame(self, timeout=None):
+        """
+        最多等 timeout 秒
+
+        :return: 有新的一帧返回 (画面, emphasis), 画面是 bytes, 否则返回 None
+        """
+        if not self._ready.wait(timeout):
+            return None
+        self._ready.clear()
+        buffer = self._memory.buf
+        while True:
+            frames = struct.unpack_from('<I', buffer, _FRAMES)[0]
+            if frames == self._frames:
+                return None
+            latest = buffer[_LATEST]
+            start = _BUFFERS + latest * FRAME_SIZE
+            frame = bytes(buffer[start:start + FRAME_SIZE])
+            emphasis = buffer[_EMPHASIS + latest]
+            if struct.unpack_from('<I', buffer, _FRAMES)[0] == frames:
+                self._dropped += frames - self._frames - 1
+                self._frames = frames
+                return frame, emphasis
@@ -1,4 +1,8 @@
 from utils import *
+from alu import ADC_TABLE, ASL_TABLE, LSR_TABLE, ROL_TABLE, ROR_TABLE, nz_from_status, flag_z, flag_n
+from codegen import build_handlers, operand_kinds
+from recompiler import Recompiler
+from idle import IdleLoopDetector
 
 
 class CPU:
@@ -7,12 +11,24 @@ class CPU:
         The addresses to jump to when an interrupt occurs are stored in a vector table in
         the program code at $FFFA-$FFFF. When an interrupt occurs the system performs the
         following actions:
+
+    指令分发
+        table       用 _instruction_set 查表, 寻址和执行分两次方法调用
+        generated   每个 opcode 生成一个处理函数, 用 256 项的列表查找
+                    PRG-ROM 里的指令解码一次之后缓存 (opcode, 处理函数, 操作数), 不再经过总线读
+        recompiled  run 按基本块执行重编译过的代码, 其他时候和 generated 相同
+
+    空转循环
+        idle_skip 打开时, run 在 pc 往回跳之后检查空转循环, 直接跳到下一个 PPU 事件, 见 IdleLoopDetector
     """
 
-    def __init__(self):
+    def __init__(self, dispatch='table', idle_skip=False):
         self._setup_instruction_set()
         self._setup_status_flags()
         self._bus = None
+        self._setup_dispatch(dispatch)
+        self._idle_skip = idle_skip
+        self._idle = None
 
         # 操作数
         self._opcode = None
@@ -20,6 +36,14 @@ class CPU:
         self._cycles = 0
         # 执行当前指令需要消耗的 CPU 周期
         self._defer_cycles = 0
+        # NMI、IRQ 和 DMA 暂停在指令之间处理, _pending 表示其中之一还没处理
+        self._nmi_pending = False
+        # mapper 的 IRQ 信号, 撤销之前一直有效
+        self._irq_line = False
+        self._stall_cycles = 0
+        self._pending = False
+        # 让 run 在当前指令之后返回
+        self._end_run = False
         self._current_instruction = None
         # debug
         self.debug = True
@@ -29,6 +53,15 @@ class CPU:
     def cycles(self):
         return self._cycles
 
+    @property
+    def idle_cycles(self):
+        """
+        空转循环一共跳过的周期, 已经算在 cycles 里
+        """
+        if self._idle is None:
+            return 0
+        return self._idle.skipped
+
     @property
     def instruction_set(self):
         """
@@ -60,13 +93,13 @@ class CPU:
     @property
     def status(self):
         v = ((self._flag_c << 0) +
-             (self._flag_z << 1) +
+             (flag_z(self._nz) << 1) +
              (self._flag_i << 2) +
              (self._flag_d << 3) +
              (self._flag_b << 4) +
              (1 << 5) +
              (self._flag_v << 6) +
-             (self._flag_n << 7))
+             (flag_n(self._nz) << 7))
         return v
 
     def _setup_instruction_set(self):
@@ -266,6 +299,20 @@ class CPU:
         i[0x6E] = (self._ror, self._address_abs, 'ROL', 'ABS', 3, 6)
         i[0x7E] = (self._ror, self._address_abs_x_write, 'ROL', 'ABX', 3, 7)
 
+    def _setup_dispatch(self, dispatch):
+        self._dispatch = dispatch
+        self._handlers = None
+        # pc -> 解码好的指令, 只缓存 PRG-ROM
+        self._decoded = None
+        self._operand_kinds = None
+        self._recompiler = None
+        if dispatch in ('generated', 'recompiled'):
+            self.emulate = self._emulate_generated
+            if dispatch == 'recompiled':
+                self.run = self._run_recompiled
+        elif dispatch != 'table':
+            raise RuntimeError("未知的指令分发方式 {}".format(dispatch))
+
     def _setup_registers(self):
         """
         初始化寄存器
@@ -285,12 +332,12 @@ class CPU:
         初始化 CPU 标志位
         """
         self._flag_c = 0
-        self._flag_z = 0
         self._flag_i = 0
         self._flag_d = 0
         self._flag_b = 0
         self._flag_v = 0
-        self._flag_n = 0
+        # N Z 延迟计算, 见 alu
+        self._nz = 1
 
     def _stack_push_byte(self, byte):
         """
@@ -335,42 +382,34 @@ class CPU:
         return self._bus.write_word(address, value)
 
     def _shift_right(self, value):
-        self._set_carry_flag(bool(value & 0x01))
-        result = value >> 1
-        self._set_zero_flag(not result)
-        self._set_negative_flag(bool(result & 0x80))
-        return result
+        entry = LSR_TABLE[value]
+        self._flag_c = entry >> 8
+        self._nz = entry & 0xFF
+        return entry & 0xFF
 
     def _shift_left(self, value):
-        self._set_carry_flag(bool(value & 0x80))
-        result = (value << 1) & 0xFF
-        self._set_zero_flag(not result)
-        self._set_negative_flag(bool(result & 0x80))
-        return result
+        entry = ASL_TABLE[value]
+        self._flag_c = entry >> 8
+        self._nz = entry & 0xFF
+        return entry & 0xFF
 
     def _rotate_left(self, value):
-        result = ((value << 1) & 0xFF) | self._flag_c
-        self._set_carry_flag(bool(value & 0x80))
-        self._set_zero_flag(not result)
-        self._set_negative_flag(bool(result & 0x80))
-        return result
+        entry = ROL_TABLE[(self._flag_c << 8) | value]
+        self._flag_c = entry >> 8
+        self._nz = entry & 0xFF
+        return entry & 0xFF
 
     def _rotate_right(self, value):
-        result = (value >> 1) | (self._flag_c << 7)
-        self._set_carry_flag(bool(value & 0x1))
-        self._set_zero_flag(not result)
-        self._set_negative_flag(bool(result & 0x80))
-        return result
+        entry = ROR_TABLE[(self._flag_c << 8) | value]
+        self._flag_c = entry >> 8
+        self._nz = entry & 0xFF
+        return entry & 0xFF
 
     # TODO 重构 _set_flag_zero _clear_flag_zero
     def _set_carry_flag(self, condition):
         v = 1 if condition else 0
         self._flag_c = v
 
-    def _set_zero_flag(self, condition):
-        v = 1 if condition else 0
-        self._flag_z = v
-
     def _set_interrupt_disabled_flag(self, condition):
         v = 1 if condition else 0
         self._flag_i = v
@@ -387,10 +426,6 @@ class CPU:
         v = 1 if condition else 0
         self._flag_v = v
 
-    def _set_negative_flag(self, condition):
-        v = 1 if condition else 0
-        self._flag_n = v
-
     """
     寻址模式
     """
@@ -571,15 +606,13 @@ class CPU:
 
         # TODO 重构 set_register_a set_register_x
         a = self._accumulator
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _sta(self):
         self._write_byte(self._operand, self._accumulator)
 
     def _bpl(self):
-        if self._flag_n == 0:
+        if not self._nz & 0x8080:
             self._tick()
 
             target = self._program_counter + self._operand
@@ -605,15 +638,13 @@ class CPU:
         self._register_x = m
 
         a = self._register_x
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _txs(self):
         self._stack_pointer = self._register_x
 
     def _bne(self):
-        if self._flag_z == 0:
+        if self._nz & 0xFF:
             self._tick()
 
             target = self._program_counter + self._operand
@@ -628,16 +659,13 @@ class CPU:
 
         v = a - m
         self._set_carry_flag(v >= 0)
-        self._set_zero_flag(v == 0)
-        self._set_negative_flag(((v >> 7) & 1) == 1)
+        self._nz = v & 0xFF
 
     def _txa(self):
         self._accumulator = self._register_x
 
         a = self._accumulator
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _jsr(self):
         # 1 Byte 指令 2 Byte 地址
@@ -652,7 +680,7 @@ class CPU:
         self._program_counter = self._operand
 
     def _beq(self):
-        if self._flag_z == 1:
+        if not self._nz & 0xFF:
             self._tick()
 
             target = self._program_counter + self._operand
@@ -667,8 +695,7 @@ class CPU:
 
         v = (a - m)
         self._set_carry_flag(v >= 0)
-        self._set_zero_flag(v == 0)
-        self._set_negative_flag(((v >> 7) & 1) == 1)
+        self._nz = v & 0xFF
 
     def _bcs(self):
         if self._flag_c == 1:
@@ -681,7 +708,7 @@ class CPU:
             self._program_counter = target
 
     def _bmi(self):
-        if self._flag_n == 1:
+        if self._nz & 0x8080:
             self._tick()
 
             target = self._program_counter + self._operand
@@ -694,9 +721,7 @@ class CPU:
         a = self._read_byte(self._operand)
         self._register_y = a
 
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _sty(self):
         self._write_byte(self._operand, self._register_y)
@@ -705,28 +730,20 @@ class CPU:
         self._set_carry_flag(True)
 
     def _sbc(self):
+        # A - M - (1 - C) = A + (M ^ 0xFF) + C
         m = self._read_byte(self._operand)
-        a = self._accumulator
-        c = self._flag_c
-        v = a + (m ^ 0xFF) + c
-        self._set_overflow_flag((a ^ m) & (a ^ v) & 0x80)
-        self._set_carry_flag(v & 0x100)
-        self._accumulator = v & 0xFF
-
-        self._set_zero_flag(self._accumulator == 0)
-        self._set_negative_flag(self._accumulator & 0x80)
+        self._add(m ^ 0xFF)
 
     def _adc(self):
-        value = self._read_byte(self._operand)
-        result = value + self._accumulator + self._flag_c
-        signed_result = (
-                byte_to_signed_int(value) + byte_to_signed_int(self._accumulator) + self._flag_c
-        )
-        self._set_carry_flag(result > 255)
-        self._accumulator = result & 0xFF
-        self._set_zero_flag(not self._accumulator)
-        self._set_overflow_flag(signed_result < -128 or signed_result > 127)
-        self._set_negative_flag(bool(result & 0x80))
+        m = self._read_byte(self._operand)
+        self._add(m)
+
+    def _add(self, value):
+        entry = ADC_TABLE[(self._flag_c << 16) | (self._accumulator << 8) | value]
+        self._accumulator = entry & 0xFF
+        self._flag_c = (entry >> 8) & 1
+        self._flag_v = entry >> 9
+        self._nz = self._accumulator
 
     def _clc(self):
         self._set_carry_flag(False)
@@ -747,33 +764,25 @@ class CPU:
         self._accumulator = m | self._accumulator
 
         a = self._accumulator
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _tax(self):
         self._register_x = self._accumulator
 
         a = self._register_x
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _tay(self):
         self._register_y = self._accumulator
 
         a = self._register_y
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _tya(self):
         self._accumulator = self._register_y
 
         a = self._accumulator
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _bcc(self):
         if self._flag_c == 0:
@@ -788,54 +797,41 @@ class CPU:
     def _dex(self):
         self._register_x = (self._register_x - 1) & 0xFF
         a = self._register_x
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _dey(self):
         self._register_y = (self._register_y - 1) & 0xFF
         a = self._register_y
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _iny(self):
         self._register_y = (self._register_y + 1) & 0xFF
         a = self._register_y
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _inx(self):
         self._register_x = (self._register_x + 1) & 0xFF
         a = self._register_x
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _inc(self):
         m = (self._read_byte(self._operand) + 1) & 0xFF
         self._write_byte(self._operand, m)
         a = m
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _dec(self):
         m = (self._read_byte(self._operand) - 1) & 0xFF
         self._write_byte(self._operand, m)
         a = m
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _cpy(self):
         m = self._read_byte(self._operand)
         y = self._register_y
         a = y - m
         self._set_carry_flag(a >= 0)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(((a >> 7) & 1) == 1)
+        self._nz = a & 0xFF
 
     def _pha(self):
         self._stack_push_byte(self._accumulator)
@@ -844,9 +840,7 @@ class CPU:
         self._accumulator = self._stack_pop_byte()
 
         a = self._accumulator
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _php(self):
         self._stack_push_byte(self.status | 0b00010000)
@@ -855,11 +849,10 @@ class CPU:
         value = self._stack_pop_byte()
 
         self._set_carry_flag(bool(value & 0x1))
-        self._set_zero_flag(bool(value & 0x2))
         self._set_interrupt_disabled_flag(bool(value & 0x4))
         self._set_decimal_mode_flag(bool(value & 0x8))
         self._set_overflow_flag(bool(value & 0x40))
-        self._set_negative_flag(bool(value & 0x80))
+        self._nz = nz_from_status(value)
 
     def _stx(self):
         self._write_byte(self._operand, self._register_x)
@@ -870,8 +863,8 @@ class CPU:
     def _bit(self):
         v = self._read_byte(self._operand)
         self._set_overflow_flag(bool(v & 0b01000000))
-        self._set_negative_flag(bool(v & 0b10000000))
-        self._set_zero_flag(not (self._accumulator & v))
+        # N 是内存的第 7 位, 和 Z 无关
+        self._nz = (self._accumulator & v) | ((v & 0x80) << 8)
 
     def _bvs(self):
         if self._flag_v == 1:
@@ -899,22 +892,18 @@ class CPU:
     def _and(self):
         m = self._read_byte(self._operand)
         self._accumulator = self._accumulator & m
-        self._set_zero_flag(not self._accumulator)
-        self._set_negative_flag(bool(self._accumulator & 0x80))
+        self._nz = self._accumulator
 
     def _eor(self):
         value = self._read_byte(self._operand)
         self._accumulator = self._accumulator ^ value
-        self._set_zero_flag(not self._accumulator)
-        self._set_negative_flag(bool(self._accumulator & 0x80))
+        self._nz = self._accumulator
 
     def _tsx(self):
         self._register_x = self._stack_pointer
 
         a = self._register_x
-        bit7 = (a >> 7)
-        self._set_zero_flag(a == 0)
-        self._set_negative_flag(bit7 == 1)
+        self._nz = a
 
     def _lsr(self):
         if self._opcode == 0x4A:
@@ -955,11 +944,10 @@ class CPU:
     def _rti(self):
         value = self._stack_pop_byte()
         self._set_carry_flag(bool(value & 0x1))
-        self._set_zero_flag(bool(value & 0x2))
         self._set_interrupt_disabled_flag(bool(value & 0x4))
         self._set_decimal_mode_flag(bool(value & 0x8))
         self._set_overflow_flag(bool(value & 0x40))
-        self._set_negative_flag(bool(value & 0x80))
+        self._nz = nz_from_status(value)
 
         self._program_counter = self._stack_pop_word()
 
@@ -967,11 +955,20 @@ class CPU:
         self._setup_status_flags()
         self._setup_registers()
 
-        self._cycles = 0
+        # reset 占用 8 个周期, 和指令一样在开始时就计入 cycles
         self._defer_cycles = 8
+        self._cycles = self._defer_cycles
 
     def connect_to_bus(self, bus):
         self._bus = bus
+        if self._dispatch in ('generated', 'recompiled'):
+            self._handlers = build_handlers(self._instruction_set, bus)
+            self._decoded = [None] * 0x10000
+            self._operand_kinds = operand_kinds(self._instruction_set)
+        if self._dispatch == 'recompiled':
+            self._recompiler = Recompiler(self, bus)
+        if self._idle_skip:
+            self._idle = IdleLoopDetector(self, bus)
         self._setup_registers()
 
     def _decode_opcode(self):
@@ -994,20 +991,127 @@ class CPU:
         p = self.status & 0xdf
         x = self._register_x
         y = self._register_y
-        a1, b1, name, *others = self._current_instruction
         # log(name, 'PC', pc, 'OP', op, 'A', a, 'sp', sp, 'p', p, 'x', x, 'y', y)
         return [pc, op, a, sp, p, x, y]
 
     def tick(self):
         if self._defer_cycles == 0:
-            self.emulate()
+            cycles = self.handle_pending() if self._pending else 0
+            if cycles:
+                self._defer_cycles = cycles
+            else:
+                self.emulate()
         self._defer_cycles -= 1
 
+    def run(self, max_cycles):
+        """
+        连续执行整条指令, 直到用完 max_cycles 个周期, 或者有 end_run 请求
+        指令之间处理 NMI 和 IRQ, 最后一条指令可能超出预算
+
+        :return: 实际消耗的周期, 包括跨页和分支增加的周期
+        """
+        # tick 留下的还没走完的周期
+        cycles = self._defer_cycles
+        emulate = self.emulate
+        idle = self._idle
+        while cycles < max_cycles:
+            if self._pending:
+                handled = self.handle_pending()
+                cycles += handled
+                if self._end_run:
+                    self._end_run = False
+                    break
+                if handled:
+                    continue
+            pc = self._program_counter
+            cycles += emulate()
+            if self._program_counter <= pc and idle is not None:
+                cycles += idle.skip(max_cycles - cycles)
+        self._defer_cycles = 0
+        return cycles
+
+    def _run_recompiled(self, max_cycles):
+        """
+        和 run 相同, 但每次执行一个基本块
+        """
+        cycles = self._defer_cycles
+        blocks = self._recompiler.blocks
+        compile_block = self._recompiler.compile
+        idle = self._idle
+        while cycles < max_cycles:
+            if self._pending:
+                handled = self.handle_pending()
+                cycles += handled
+                if self._end_run:
+                    self._end_run = False
+                    break
+                if handled:
+                    continue
+            pc = self._program_counter
+            block = blocks[pc]
+            if block is None:
+                block = compile_block(pc)
+            cycles += block(max_cycles - cycles)
+            if self._program_counter <= pc and idle is not None:
+                cycles += idle.skip(max_cycles - cycles)
+        self._defer_cycles = 0
+        return cycles
+
     def emulate(self):
         self._opcode_from_memory()
         self._decode_opcode()
         self._execute_instruction()
         self._update_clock_cycles()
+        return self._defer_cycles
+
+    def _decode(self, pc):
+        """
+        解码 pc 处的指令, PRG-ROM 里的结果放进 _decoded
+
+        :return: (opcode, 处理函数, 操作数)
+        """
+        read_byte = self._bus.read_byte
+        opcode = read_byte(pc)
+        kind = self._operand_kinds[opcode]
+        if kind == 'byte':
+            operand = read_byte(pc + 1)
+        elif kind == 'word':
+            operand = self._bus.read_word(pc + 1)
+        elif kind == 'offset':
+            operand = (read_byte(pc + 1) ^ 0x80) - 0x80
+        else:
+            operand = None
+        decoded = (opcode, self._handlers[opcode], operand)
+        if pc >= 0x8000:
+            self._decoded[pc] = decoded
+        return decoded
+
+    def invalidate_rom(self, start=0x8000, end=0x10000):
+        """
+        PRG-ROM 的 start - end 变了 (mapper 切换 bank), 作废按 pc 缓存的解码结果、重编译的块和空转循环
+        前面的指令可能跨进这一段, 多作废指令的最大长度
+        """
+        if self._decoded is not None:
+            first = max(start - 2, 0x8000)
+            self._decoded[first:end] = [None] * (end - first)
+        if self._recompiler is not None:
+            self._recompiler.invalidate_rom(start, end)
+        if self._idle is not None:
+            self._idle.invalidate()
+
+    def _emulate_generated(self):
+        """
+        处理函数里已经包含了寻址、执行和基础周期
+        """
+        pc = self._program_counter
+        decoded = self._decoded[pc]
+        if decoded is None:
+            decoded = self._decode(pc)
+        self._opcode, handler, operand = decoded
+        cycles = handler(self, operand)
+        self._defer_cycles = cycles
+        self._cycles += cycles
+        return cycles
 
     def _tick(self):
         self._defer_cycles += 1
@@ -1015,12 +1119,82 @@ class CPU:
     def _update_clock_cycles(self):
         self._cycles += self._defer_cycles
 
+    def trigger_nmi(self):
+        """
+        PPU 进入 vblank 时调用, 等当前指令执行完再处理
+        """
+        self._nmi_pending = True
+        self._pending = True
+
+    def trigger_irq(self):
+        """
+        mapper 产生 IRQ, 一直有效到 clear_irq, I 标志为 0 时在指令之间处理
+        """
+        self._irq_line = True
+        self._pending = True
+
+    def clear_irq(self):
+        self._irq_line = False
+
+    def end_run(self):
+        """
+        下一个事件可能提前了 (比如改了 mapper 的 IRQ), run 在当前指令之后返回, 由 console 重新计算
+        """
+        self._end_run = True
+        self._pending = True
+
+    def stall(self, cycles):
+        """
+        DMA 占用总线, 当前指令执行完之后 CPU 暂停 cycles 个周期, 奇数周期开始时再加 1 个
+        写 $4014 的指令执行时 cycles 还是指令开始时的值, 不同寻址方式写的周期不同, 所以在 handle_pending 里对齐
+        """
+        self._stall_cycles += cycles
+        self._pending = True
+
+    def handle_pending(self):
+        """
+        先暂停, 再处理 NMI 或 IRQ
+        IRQ 是电平触发的, I 标志为 1 时不处理, _pending 保持到 IRQ 撤销, 每条指令之前都会再检查
+
+        :return: 消耗的周期, 什么都没处理时是 0
+        """
+        self._pending = self._irq_line
+        cycles = self._stall_cycles
+        if cycles:
+            self._stall_cycles = 0
+            # 写是指令的最后一个周期, DMA 从下一个周期开始, 这个周期是奇数时多等 1 个周期
+            cycles += self._cycles & 1
+            self._cycles += cycles
+        if self._nmi_pending:
+            cycles += self.handle_nmi()
+        elif self._irq_line and not self._flag_i:
+            cycles += self.handle_irq()
+        return cycles
+
     def handle_nmi(self):
+        """
+        :return: 处理 NMI 消耗的周期
+        """
+        self._nmi_pending = False
         self._stack_push_word(self._program_counter)
         self._stack_push_byte(self.status | 0b00010000)
         self._set_interrupt_disabled_flag(True)
         self._program_counter = self._read_word(0xFFFA)
-        self._defer_cycles += 7
+        self._cycles += 7
+        return 7
+
+    def handle_irq(self):
+        """
+        和 BRK 共用 $FFFE 的向量, 压栈的状态 B 标志为 0, 中断程序靠它区分
+
+        :return: 处理 IRQ 消耗的周期
+        """
+        self._stack_push_word(self._program_counter)
+        self._stack_push_byte(self.status & 0b11101111)
+        self._set_interrupt_disabled_flag(True)
+        self._program_counter = self._read_word(0xFFFE)
+        self._cycles += 7
+        return 7
 
     def _opcode_from_memory(self):
         self._opcode = self._read_byte(self._program_counter)
@@ -1,32 +1,47 @@
 import pygame
 import threading
-from cpu import CPU
-from ppu import PPU
 from window import Window
-from joypad import Joypad
-from memory.ram import RAM
-from bus.cpu_bus import CPUBus
-from bus.ppu_bus import PPUBus
-from cartridge import Cartridge
+from console import Console
+from core import CoreProcess, FrameHandoff, FramePacer, run_console, TURBO_SPEED, SLOW_SPEED
+
+
+# 显示线程等待新的一帧的最长时间, 秒
+FRAME_WAIT = 1 / 60
 
 
 class Emulator:
     """
     each PPU frame takes 341*262=89342 PPU clocks cycles
     CPU is guaranteed to receive NMI every interrupt ~29780 CPU cycles
+
+    frameskip 是每画一帧之后跳过的帧数, 'auto' 表示模拟比真实时间慢的时候自动跳过
+    process 为 True 时模拟核心在子进程里运行, 见 core.py
+    speed 是相对 NTSC 60.0988 帧每秒的速度倍数, None 是不限速
+        按住 Tab 加速, 按住左 Shift 慢放, 按住 ` 不限速, 松开恢复 speed
     """
-    def __init__(self, rom_path):
+    def __init__(self, rom_path, scale=2, frameskip=0, process=False, speed=1.0):
         self._rom_path = rom_path
-        self._cartridge = Cartridge(self._rom_path)
-        self._setup_cpu_bus()
-        self._setup_ppu_bus()
-        self._window = Window()
+        self._frameskip = frameskip
+        self._speed = speed
+        if process:
+            self._core = CoreProcess(self._rom_path, frameskip, speed)
+            self._console = None
+            self._joypad = self._core.joypad
+        else:
+            self._core = None
+            self._frames = FrameHandoff()
+            self._pacer = FramePacer(speed)
+            # 窗口关闭后让模拟线程停下
+            self._stopping = False
+            self._console = Console(self._rom_path)
+            self._cpu = self._console.cpu
+            self._ppu = self._console.ppu
+            self._joypad = self._console.joypad
+        self._window = Window(scale)
         self._register_event_handler()
         self._cycles = 0
         self._counter = 0
 
-        self._cpu.reset()
-        
     def _register_event_handler(self):
         j = self._joypad
         register_key_event_handler = self._window.register_key_event_handler
@@ -39,42 +54,63 @@ class Emulator:
         register_key_event_handler(pygame.K_a, (j.left.key_down, j.left.key_up))
         register_key_event_handler(pygame.K_d, (j.right.key_down, j.right.key_up))
 
-    def _setup_cpu_bus(self):
-        size = self._cartridge.sram_bank * 8 * 1024
-        sram = RAM(size)
-        ram = RAM(0x0800)
-        self._joypad = Joypad()
-        IO_registers = RAM(0x20)
-        self._ppu = PPU()
-        self._cpu = CPU()
-        self._cpu_bus = CPUBus(self._cpu, self._ppu, ram, sram, self._cartridge, self._joypad, IO_registers)
-
-    def _setup_ppu_bus(self):
-        vram = RAM(0x1000)  # 4K
-        background_palette = RAM(16)
-        sprite_palette = RAM(16)
-        self._ppu_bus = PPUBus(self._ppu, vram, self._cartridge, background_palette, sprite_palette)
+        for key, speed in ((pygame.K_TAB, TURBO_SPEED), (pygame.K_LSHIFT, SLOW_SPEED), (pygame.K_BACKQUOTE, None)):
+            register_key_event_handler(key, self._speed_handlers(speed))
+
+    def _speed_handlers(self, speed):
+        return lambda: self._set_speed(speed), lambda: self._set_speed(self._speed)
+
+    def _set_speed(self, speed):
+        if self._core is not None:
+            self._core.speed = speed
+        else:
+            self._pacer.speed = speed
 
     def tick(self):
-        while True:
-            self._cpu.tick()
-            self._ppu.tick()
-            self._ppu.tick()
-            self._ppu.tick()
+        run_console(self._console, self._frameskip, self._frames.publish, self._running, self._pacer)
+
+    def _running(self):
+        return self._window.running and not self._stopping
 
     def run(self):
         """
-        Catch-up
+        Catch-up 调度在 Console 里
         http://wiki.nesdev.com/w/index.php/Catch-up
+
+        模拟在线程或者子进程里运行, 速度由 FramePacer 控制
+        这里等新的一帧, 没有新的一帧时睡眠, 不占用 CPU, 只在有新的一帧时刷新画面
+        """
+        if self._core is not None:
+            frames = self._core
+            frames.start()
+        else:
+            frames = self._frames
+            thread = threading.Thread(target=self.tick, daemon=True)
+            thread.start()
+        try:
+            while self._window.running:
+                self._window.update()
+                # 等待时也要定时处理窗口事件
+                frame = frames.next_frame(FRAME_WAIT)
+                if frame is not None:
+                    self._window.update_frame(*frame)
+                    self._window.draw()
+        finally:
+            if self._core is not None:
+                self._core.stop()
+            else:
+                # 模拟线程跑完当前这一帧就退出, 之后才能关闭 ROM
+                self._stopping = True
+                thread.join()
+                self._console.close()
+
+    @property
+    def dropped_frames(self):
+        """
+        模拟画出了但是来不及显示的帧数
         """
-        p = threading.Thread(target=self.tick)
-        p.start()
-        while True:
-            self._window.update()
-            if self._ppu.frame_ready:
-                self._window.update_frame(self._ppu.frame_buffer)
-                self._ppu.frame_ready = False
-                self._window.draw()
+        source = self._core if self._core is not None else self._frames
+        return source.dropped_frames
 
 
 def main():
@@ -0,0 +1,140 @@
+from codegen import describe
+
+# 空转循环里允许的指令, 只读内存和改寄存器, 不写内存不碰栈
+_IDLE_INSTRUCTIONS = ('lda', 'ldx', 'ldy', 'cmp', 'cpx', 'cpy', 'bit', 'and', 'ora', 'eor', 'nop',
+                      'tax', 'tay', 'txa', 'tya', 'sec', 'clc', 'cld', 'clv')
+_IDLE_BRANCHES = ('bpl', 'bmi', 'bvc', 'bvs', 'bcc', 'bcs', 'bne', 'beq')
+# 地址在编译时就确定的寻址模式
+_IDLE_MODES = ('imp', 'imm', 'zp', 'abs')
+
+# 循环体最多的指令数
+MAX_LOOP_INSTRUCTIONS = 8
+
+
+def _is_stable(address):
+    """
+    在两个 PPU 事件之间, 重复读这个地址得到的值不变, 也没有新的副作用
+    RAM 只有 CPU 自己会写, $2002 只在事件点改变, 读它清掉的 vblank 和 w 在第一次读之后就不变了
+    """
+    if address < 0x2000 or address >= 0x6000:
+        return True
+    return address < 0x4000 and (address & 0x7) == 0x2
+
+
+class IdleLoopDetector:
+    """
+    空转循环检测
+        游戏经常在一个很短的循环里等 vblank 或者 NMI 设置的标志, 比如
+            LDA $2002 / BPL
+            LDA $xx / BEQ
+            JMP *
+        这种循环只读不写, 寄存器在每次回到循环开头时都一样,
+        所以在下一个 PPU 事件 (vblank, pre-render, 帧结束) 之前结果不会改变
+
+        CPU 跳回到更小的 pc 时调用 skip
+        循环开头的 pc 先做静态检查, 循环体只能包含 _IDLE_INSTRUCTIONS, 访问的地址都要 _is_stable
+        连续两次回到循环开头时寄存器相同, 下一个 PPU 事件相同, 经过的周期等于一次循环的周期, 就确认是空转
+        然后一次加上整数次循环的周期, 不超过 run 的预算, 也不跨过下一个 PPU 事件,
+        跳过之后 CPU 的状态和周期数和逐条执行完全相同
+    """
+    def __init__(self, cpu, bus):
+        self._cpu = cpu
+        self._bus = bus
+        self._instruction_set = cpu.instruction_set
+        # 循环开头的 pc -> 一次循环的周期, 不是空转循环的是 0
+        self._loops = {}
+        # 上一次回到循环开头时的 pc, 寄存器和周期
+        self._head = None
+        self._state = None
+        self._cycles = 0
+        # 一共跳过的周期
+        self.skipped = 0
+
+    def invalidate(self):
+        """
+        PRG-ROM 的内容变了 (mapper 切换 bank), 之前的静态检查作废
+        """
+        self._loops = {}
+        self._head = None
+
+    def _loop_cycles(self, head):
+        """
+        静态检查从 head 开始的循环体
+        :return: 一次循环的周期, 不是空转循环返回 0
+        """
+        read_byte = self._bus.read_byte
+        pc = head
+        cycles = 0
+        for _ in range(MAX_LOOP_INSTRUCTIONS):
+            # 只检查 PRG-ROM 里的循环, RAM 里的代码可能被改掉
+            if not 0x8000 <= pc <= 0xFFFD:
+                return 0
+            opcode = read_byte(pc)
+            instruction = self._instruction_set.get(opcode)
+            if instruction is None:
+                return 0
+            name, mode, length, base = describe(instruction)
+            next_pc = pc + length
+            if name == 'jmp' and mode == 'abs':
+                target = read_byte(pc + 1) | (read_byte(pc + 2) << 8)
+                return cycles + base if target == head else 0
+            elif name in _IDLE_BRANCHES:
+                offset = (read_byte(pc + 1) ^ 0x80) - 0x80
+                target = (next_pc + offset) & 0xFFFF
+                if target == head:
+                    # 跳转加 1, 跨页再加 1
+                    page = 1 if (target ^ next_pc) & 0xFF00 else 0
+                    return cycles + base + 1 + page
+                # 循环里的其他分支不跳转才会回到开头
+                cycles += base
+            elif name in _IDLE_INSTRUCTIONS and mode in _IDLE_MODES:
+                if mode == 'zp':
+                    address = read_byte(pc + 1)
+                elif mode == 'abs':
+                    address = read_byte(pc + 1) | (read_byte(pc + 2) << 8)
+                else:
+                    address = None
+                if address is not None and not _is_stable(address):
+                    return 0
+                cycles += base
+            else:
+                return 0
+            pc = next_pc
+        return 0
+
+    def skip(self, budget):
+        """
+        CPU 跳回循环开头之后调用
+
+        :param budget: run 剩下的周期
+        :return: 跳过的周期, 已经加到 CPU 上
+        """
+        cpu = self._cpu
+        head = cpu._program_counter
+        loop = self._loops.get(head)
+        if loop is None:
+            loop = self._loop_cycles(head)
+            self._loops[head] = loop
+        if loop == 0:
+            return 0
+
+        # 两次回到开头之间没有经过 PPU 事件, 这次循环读到的就是事件之前的值
+        event = self._bus.next_event_cycles()
+        state = (cpu._accumulator, cpu._register_x, cpu._register_y, cpu._stack_pointer, cpu.status, event)
+        now = cpu._cycles
+        if head != self._head or state != self._state or now - self._cycles != loop:
+            self._head = head
+            self._state = state
+            self._cycles = now
+            return 0
+
+        # 跳过之后至少还差一个周期才到预算, 剩下的部分逐条执行
+        count = min((budget - 1) // loop, (event - now) // loop)
+        if count <= 0:
+            self._cycles = now
+            return 0
+        skipped = count * loop
+        cpu._cycles += skipped
+        self._cycles = cpu._cycles
+        self.skipped += skipped
+        return skipped
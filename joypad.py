@@ -52,3 +52,13 @@ class Joypad:
         self._strobe = ((data & 1) == 1)
         if self._strobe:
             self._index = 0
+
+    def update(self, state):
+        """
+        按位设置 8 个键, 第 0 - 7 位的顺序和读出的顺序相同
+        """
+        for i, key in enumerate(self._keys):
+            if (state >> i) & 1:
+                key.key_down()
+            else:
+                key.key_up()
@@ -0,0 +1,22 @@
+from ppu import MirroringType
+from mapper.nrom import Mapper
+
+
+class AxROM(Mapper):
+    """
+    mapper 7
+    https://wiki.nesdev.com/w/index.php/AxROM
+        写 $8000-$FFFF, 低 3 位选择 $8000-$FFFF 的 32KB PRG bank,
+        第 4 位选择单屏 mirroring 用 vram 的哪一个 1KB, CHR 是 8KB CHR-RAM
+    """
+    def reset(self):
+        self._cartridge.map_prg(0x8000, 0x8000, 0)
+        self._cartridge.map_chr(0x0000, 0x2000, 0)
+        self._cartridge.set_mirroring_type(MirroringType.Single_Screen_Lower)
+
+    def write_register(self, address, data):
+        self._cartridge.map_prg(0x8000, 0x8000, data & 0x07)
+        if data & 0x10:
+            self._cartridge.set_mirroring_type(MirroringType.Single_Screen_Upper)
+        else:
+            self._cartridge.set_mirroring_type(MirroringType.Single_Screen_Lower)
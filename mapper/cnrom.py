@@ -0,0 +1,11 @@
+from mapper.nrom import Mapper
+
+
+class CNROM(Mapper):
+    """
+    mapper 3
+    https://wiki.nesdev.com/w/index.php/CNROM
+        PRG 和 NROM 一样固定, 写 $8000-$FFFF 的值选择 8KB CHR bank
+    """
+    def write_register(self, address, data):
+        self._cartridge.map_chr(0x0000, 0x2000, data)
@@ -0,0 +1,83 @@
+from ppu import MirroringType
+from mapper.nrom import Mapper
+
+
+# control 寄存器低 2 位对应的 mirroring
+_MIRRORING = [
+    MirroringType.Single_Screen_Lower,
+    MirroringType.Single_Screen_Upper,
+    MirroringType.Vertical,
+    MirroringType.Horizontal,
+]
+
+
+class MMC1(Mapper):
+    """
+    mapper 1
+    https://wiki.nesdev.com/w/index.php/MMC1
+        寄存器通过 5 位的移位寄存器串行写入, 每次写 $8000-$FFFF 送进数据的第 0 位,
+        第 5 次写的地址决定写哪个寄存器, 第 7 位为 1 的写复位移位寄存器
+
+        $8000-$9FFF control     mirroring, PRG 模式, CHR 模式
+        $A000-$BFFF CHR bank 0
+        $C000-$DFFF CHR bank 1
+        $E000-$FFFF PRG bank
+
+        PRG 模式 0 1 切换 32KB, 2 固定 $8000 为第一个 bank, 3 固定 $C000 为最后一个 bank
+        CHR 模式 0 切换 8KB, 1 分别切换两个 4KB
+        512KB 的 PRG (SUROM) 用 CHR bank 0 的第 4 位选择前后 256KB
+    """
+    def reset(self):
+        self._shift = 0x10
+        self._control = 0x0C
+        self._chr_bank_0 = 0
+        self._chr_bank_1 = 0
+        self._prg_bank = 0
+        self._update()
+
+    def write_register(self, address, data):
+        if data & 0x80:
+            self._shift = 0x10
+            self._control |= 0x0C
+            self._update()
+            return
+        # 最开始放进去的 1 移到第 0 位, 说明这是第 5 次写
+        complete = self._shift & 1
+        self._shift = (self._shift >> 1) | ((data & 1) << 4)
+        if not complete:
+            return
+        value = self._shift
+        self._shift = 0x10
+        register = (address >> 13) & 0x03
+        if register == 0:
+            self._control = value
+        elif register == 1:
+            self._chr_bank_0 = value
+        elif register == 2:
+            self._chr_bank_1 = value
+        else:
+            self._prg_bank = value
+        self._update()
+
+    def _update(self):
+        cartridge = self._cartridge
+        control = self._control
+        cartridge.set_mirroring_type(_MIRRORING[control & 0x03])
+
+        outer = self._chr_bank_0 & 0x10 if len(cartridge.prg_rom) > 0x40000 else 0
+        bank = outer | (self._prg_bank & 0x0F)
+        mode = (control >> 2) & 0x03
+        if mode < 2:
+            cartridge.map_prg(0x8000, 0x8000, bank >> 1)
+        elif mode == 2:
+            cartridge.map_prg(0x8000, 0x4000, outer)
+            cartridge.map_prg(0xC000, 0x4000, bank)
+        else:
+            cartridge.map_prg(0x8000, 0x4000, bank)
+            cartridge.map_prg(0xC000, 0x4000, outer | 0x0F)
+
+        if control & 0x10:
+            cartridge.map_chr(0x0000, 0x1000, self._chr_bank_0)
+            cartridge.map_chr(0x1000, 0x1000, self._chr_bank_1)
+        else:
+            cartridge.map_chr(0x0000, 0x2000, self._chr_bank_0 >> 1)
@@ -0,0 +1,109 @@
+from ppu import MirroringType
+from mapper.nrom import Mapper
+
+
+class MMC3(Mapper):
+    """
+    mapper 4
+    https://wiki.nesdev.com/w/index.php/MMC3
+        $8000 偶数 bank select   低 3 位选择 R0 - R7, 第 6 位 PRG 模式, 第 7 位交换 CHR 的两半
+        $8001 奇数 bank data     写入选中的 R0 - R7
+        $A000 偶数 mirroring     0 vertical, 1 horizontal, four screen 的卡带忽略
+        $A001 奇数 PRG-RAM 保护, 不模拟
+        $C000 偶数 IRQ latch
+        $C001 奇数 IRQ reload, 计数器清零, 下一次 clock 时重新装入 latch
+        $E000 偶数 禁止 IRQ 并撤销已经产生的 IRQ
+        $E001 奇数 允许 IRQ
+
+        CHR: R0 R1 是 2KB bank, R2 - R5 是 1KB bank
+        PRG: R6 R7 是 8KB bank, 另外两个 8KB 固定为倒数第二个和最后一个 bank
+
+    扫描线计数器
+        真机在 PPU 地址线 A12 的上升沿计数, 也就是背景用 $0000、sprite 用 $1000 时每条扫描线的 cycle 260,
+        这里简化成开启渲染时每条可见扫描线和 pre-render 扫描线计数一次
+        计数器为 0 或者要求重新装入时装入 latch, 否则减 1, 减到 0 并且允许 IRQ 时产生 IRQ
+    """
+    def reset(self):
+        self._bank_select = 0
+        self._registers = [0, 2, 4, 5, 6, 7, 0, 1]
+        self._irq_latch = 0
+        self._irq_counter = 0
+        self._irq_reload = False
+        self._irq_enabled = False
+        self._update_prg()
+        self._update_chr()
+
+    def write_register(self, address, data):
+        even = not address & 1
+        if address < 0xA000:
+            if even:
+                self._bank_select = data
+                self._update_prg()
+                self._update_chr()
+            else:
+                index = self._bank_select & 0x07
+                self._registers[index] = data
+                if index < 6:
+                    self._update_chr()
+                else:
+                    self._update_prg()
+        elif address < 0xC000:
+            if even and self._cartridge.mirroring_type is not MirroringType.Four_Screen:
+                if data & 1:
+                    self._cartridge.set_mirroring_type(MirroringType.Horizontal)
+                else:
+                    self._cartridge.set_mirroring_type(MirroringType.Vertical)
+        elif address < 0xE000:
+            if even:
+                self._irq_latch = data
+            else:
+                self._irq_counter = 0
+                self._irq_reload = True
+        else:
+            if even:
+                self._irq_enabled = False
+                self._cartridge.clear_irq()
+            else:
+                self._irq_enabled = True
+
+    def _update_prg(self):
+        cartridge = self._cartridge
+        r6 = self._registers[6]
+        r7 = self._registers[7]
+        if self._bank_select & 0x40:
+            cartridge.map_prg(0x8000, 0x2000, -2)
+            cartridge.map_prg(0xC000, 0x2000, r6)
+        else:
+            cartridge.map_prg(0x8000, 0x2000, r6)
+            cartridge.map_prg(0xC000, 0x2000, -2)
+        cartridge.map_prg(0xA000, 0x2000, r7)
+        cartridge.map_prg(0xE000, 0x2000, -1)
+
+    def _update_chr(self):
+        cartridge = self._cartridge
+        r = self._registers
+        # 第 7 位为 1 时 2KB 的 bank 在 $1000-$1FFF, 1KB 的在 $0000-$0FFF
+        invert = (self._bank_select & 0x80) << 5
+        cartridge.map_chr(0x0000 ^ invert, 0x0800, r[0] >> 1)
+        cartridge.map_chr(0x0800 ^ invert, 0x0800, r[1] >> 1)
+        cartridge.map_chr(0x1000 ^ invert, 0x0400, r[2])
+        cartridge.map_chr(0x1400 ^ invert, 0x0400, r[3])
+        cartridge.map_chr(0x1800 ^ invert, 0x0400, r[4])
+        cartridge.map_chr(0x1C00 ^ invert, 0x0400, r[5])
+
+    def clock_scanline(self):
+        if self._irq_counter == 0 or self._irq_reload:
+            self._irq_counter = self._irq_latch
+            self._irq_reload = False
+        else:
+            self._irq_counter -= 1
+        if self._irq_counter == 0 and self._irq_enabled:
+            self._cartridge.trigger_irq()
+
+    def clocks_until_irq(self):
+        if not self._irq_enabled:
+            return -1
+        if self._irq_counter == 0 or self._irq_reload:
+            # 下一次 clock 装入 latch, latch 为 0 时每次 clock 都产生 IRQ
+            return self._irq_latch + 1 if self._irq_latch else 1
+        return self._irq_counter
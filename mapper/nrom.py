@@ -0,0 +1,43 @@
+class Mapper:
+    """
+    mapper 的基类, 本身就是 NROM (mapper 0)
+        PRG 16KB 或 32KB, 只有 16KB 时 $C000 是 $8000 的镜像, CHR 8KB 固定, 没有寄存器
+
+    子类在 reset 里设置上电时的 bank, 在 write_register 里解码寄存器,
+    切换都交给卡带的 map_prg map_chr set_mirroring_type, mapper 自己不碰内存
+
+    有扫描线 IRQ 的 mapper 实现 clock_scanline 和 clocks_until_irq,
+    PPU 用 clocks_until_irq 预测 IRQ 的位置, 把它当成 CPU 可见的事件
+    """
+    def __init__(self, cartridge):
+        self._cartridge = cartridge
+
+    def reset(self):
+        self._cartridge.map_prg(0x8000, 0x4000, 0)
+        self._cartridge.map_prg(0xC000, 0x4000, -1)
+        self._cartridge.map_chr(0x0000, 0x2000, 0)
+
+    def write_register(self, address, data):
+        """
+        CPU 写 $8000-$FFFF, NROM 没有寄存器, 和真机一样忽略
+        """
+        pass
+
+    def clock_scanline(self):
+        """
+        开启渲染时每条可见扫描线和 pre-render 扫描线各调用一次
+        """
+        pass
+
+    def clocks_until_irq(self):
+        """
+        :return: 再过几次 clock_scanline 产生 IRQ, 不会产生时返回 -1
+        """
+        return -1
+
+
+class NROM(Mapper):
+    """
+    mapper 0, 行为和基类相同
+    """
+    pass
@@ -0,0 +1,12 @@
+from mapper.nrom import Mapper
+
+
+class UxROM(Mapper):
+    """
+    mapper 2
+    https://wiki.nesdev.com/w/index.php/UxROM
+        $8000-$BFFF 可以切换的 16KB PRG bank, $C000-$FFFF 固定为最后一个 bank
+        写 $8000-$FFFF 的值就是 bank 号, CHR 一般是 8KB CHR-RAM
+    """
+    def write_register(self, address, data):
+        self._cartridge.map_prg(0x8000, 0x4000, data)
@@ -64,3 +64,17 @@ palettes = [
     (0, 0, 0),
     (0, 0, 0),
 ]
+
+
+def emphasized_palettes(emphasis):
+    """
+    PPUMASK 第 5 - 7 位的颜色强调, 近似为把没有强调的颜色通道调暗到 3 / 4
+    http://wiki.nesdev.com/w/index.php/Colour_emphasis
+
+    :param emphasis: 0 - 7, 第 0 位红 第 1 位绿 第 2 位蓝
+    """
+    if emphasis == 0:
+        return palettes
+    # 某个通道只要有别的通道被强调就调暗
+    dim = [emphasis & ~(1 << i) for i in range(3)]
+    return [tuple(c * 3 // 4 if dim[i] else c for i, c in enumerate(color)) for color in palettes]
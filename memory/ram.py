@@ -17,12 +17,16 @@ class RAM(MemoryRead, MemoryWrite):
         SRAM
     $8000 - $FFFF
         PRG-ROM
+
+    存储是 bytearray, 切片返回 memoryview, 不复制, 写入时只保留低 8 位
     """
     def __init__(self, size):
         self._size = size
         self._setup_memory()
 
     def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self._view[item]
         return self._data[item]
 
     # TODO __len__
@@ -30,11 +34,19 @@ class RAM(MemoryRead, MemoryWrite):
     def size(self):
         return self._size
 
+    @property
+    def data(self):
+        """
+        背后的存储 (bytearray), 给总线的页表直接读写, 写入的值必须是 0 - 255
+        """
+        return self._data
+
     def _setup_memory(self):
-        self._data = [0] * self._size
+        self._data = bytearray(self._size)
+        self._view = memoryview(self._data)
 
     def _read(self, address):
         return self._data[address]
 
     def _write(self, address, data):
-        self._data[address] = data
+        self._data[address] = data & 0xFF
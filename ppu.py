@@ -1,14 +1,36 @@
 from enum import Enum
-import math
 
 from memory.ram import RAM
-from memory.palettes import palettes
+from compositor import create_compositor
+
+
+# 一帧里的事件位置, 按 scanline * 341 + cycle 计算
+VBLANK_DOT = 241 * 341 + 1
+PRE_RENDER_DOT = 261 * 341 + 1
+FRAME_DOTS = 262 * 341
+
+# 可见扫描线 0 - 239, 每条在 cycle 257 一次画完, 同时更新 v 的 fine y 和水平位置
+VISIBLE_LINES = 240
+RENDER_CYCLE = 257
+LAST_RENDER_DOT = (VISIBLE_LINES - 1) * 341 + RENDER_CYCLE
+# pre-render 扫描线 cycle 280 - 304 把 t 的垂直位置复制到 v, 在 304 一次完成
+COPY_VERTICAL_DOT = 261 * 341 + 304
+
+# 用 bytes.translate 给 tile 行的 2 位下标加上调色板, 0 是透明, 保持为 0
+# 背景调色板 0 - 3, sprite 调色板 4 - 7
+_PALETTE_TRANSLATIONS = [bytes([0, p * 4 + 1, p * 4 + 2, p * 4 + 3]) + bytes(252) for p in range(8)]
+# 每条扫描线最多 8 个 sprite
+MAX_LINE_SPRITES = 8
+_EMPTY_LINE = bytes(256)
 
 
 class MirroringType(Enum):
     Horizontal = 0
     Vertical = 1
     Four_Screen = 2
+    # 4 个 nametable 都是 vram 的同一个 1KB, 由 mapper 选择
+    Single_Screen_Lower = 3
+    Single_Screen_Upper = 4
 
 
 class PPU:
@@ -23,26 +45,57 @@ class PPU:
     The NES screen resolution is 320x240, thus scanlines 241 - 262 are not visible.
     """
 
-    def __init__(self):
+    def __init__(self, compositor='python'):
         self._frame = 0
         self._scanline = 240
         self._cycle = 340
         self._nmi_delay = 0
         self.frame_ready = False
-        self.frame_buffer = [(0, 0, 0)] * 256 * 240
+        # 每个像素是 NES 颜色下标 0 - 63, 对应 memory.palettes, emphasis 是这一帧的颜色强调位
+        self.frame_buffer = bytearray(256 * 240)
+        self.emphasis = 0
+
+        # 跳帧
+        #   每画一帧之后跳过 frameskip 帧, skip_next_frame 在当前帧结束时生效, 让再下一帧不画 (自动跳帧用)
+        #   跳过的帧照常更新 v, 计算 sprite 0 hit 和 overflow, 只是不画像素也不合成, frame_ready 不变
+        self.frameskip = 0
+        self.skip_next_frame = False
+        self._drawing = True
+        self._skipped_frames = 0
 
         self._setup_registers()
         self._spr_ram = RAM(256)
         self._sprite_pixels = [0] * 256
         self._pixels = [0] * (256 * 240)
 
+        # 8 个调色板 (背景 0 - 3, sprite 4 - 7) 换算成 NES 颜色下标后缓存, 调色板 RAM 被写时重新生成
+        self._palettes_dirty = True
+        self._colors = None
+        # 这一帧的 (开始的扫描线, 颜色表), 一帧中间改调色板时有多项
+        self._line_colors = []
+        self._setup_background_layers()
+        self._setup_sprites()
+        self._setup_planes(compositor)
+
         self._cpu_bus = None
         self._ppu_bus = None
+        self._mapper = None
 
     @property
     def cycle(self):
         return self._cycle
 
+    @property
+    def frame(self):
+        return self._frame
+
+    @property
+    def skipped_frames(self):
+        """
+        上一次画出的帧之后连续跳过的帧数
+        """
+        return self._skipped_frames
+
     """
     寄存器
     """
@@ -241,9 +294,6 @@ class PPU:
     def _name_table_from_vram(self):
         return self._ppu_bus.read_name_table(self.name_table_address)
 
-    def _pattern_table_from_vram(self, address):
-        return self._ppu_bus.read_pattern_table(address)
-
     def _read_ppu_status(self):
         data = self._status | self._prev_data
         self._clear_vblank_status()
@@ -278,6 +328,12 @@ class PPU:
     def connect_to_cpu_bus(self, bus):
         self._cpu_bus = bus
 
+    def connect_to_mapper(self, mapper):
+        """
+        开启渲染时每条扫描线通知 mapper, 有扫描线 IRQ 的 mapper 靠它计数
+        """
+        self._mapper = mapper
+
     def read_register(self, address):
         """
         读写 ppu 寄存器
@@ -335,105 +391,438 @@ class PPU:
 
     def write_spr_ram(self, address, data):
         self._spr_ram.write_byte(address, data)
+        self._sprites_dirty = True
 
-    def _sprite_palette_from_oam(self, attribute):
-        index = attribute & 0b11
-        start = 0x11 + index * 4
-        return [
-            palettes[self._ppu_bus.read_byte(0x3F00)],
-            palettes[self._ppu_bus.read_byte(0x3F00 + start)],
-            palettes[self._ppu_bus.read_byte(0x3F00 + start + 1)],
-            palettes[self._ppu_bus.read_byte(0x3F00 + start + 2)],
-        ]
+    def write_oam_dma(self, data):
+        """
+        OAM DMA 的 256 字节从 OAMADDR 开始写, 超过末尾回到开头
+        """
+        oam = self._spr_ram.data
+        start = self._oam_address & 0xFF
+        oam[start:] = data[:256 - start]
+        oam[:start] = data[256 - start:]
+        self._sprites_dirty = True
+
+    def mark_palettes_dirty(self):
+        """
+        PPUBus 写调色板 RAM 时调用
+        """
+        self._palettes_dirty = True
+
+    def _update_palettes(self):
+        """
+        每个调色板 4 个颜色, 第 0 个都是 $3F00 的背景色
+        平面里的像素是 4 * 调色板 + 下标, 用 translate 直接换算成 NES 颜色下标
+        """
+        read_byte = self._ppu_bus.read_byte
+        backdrop = read_byte(0x3F00) & 0x3F
+        colors = bytearray(256)
+        for index in range(32):
+            if index & 0x03:
+                colors[index] = read_byte(0x3F00 + index) & 0x3F
+            else:
+                colors[index] = backdrop
+        self._colors = bytes(colors)
+        self._palettes_dirty = False
+
+    def _snapshot_palettes(self, line):
+        """
+        记录从第 line 条扫描线开始用的颜色表
+        每帧的第 0 条扫描线, 以及调色板被改过之后画的第一条扫描线各记录一次
+        """
+        if self._palettes_dirty or self._colors is None:
+            self._update_palettes()
+        if line == 0:
+            self._line_colors = []
+        self._line_colors.append((line, self._colors))
 
-    def draw_sprite(self):
-        # TODO scroll 8 * 16
-        pattern_table = self._pattern_table_from_vram(self.sprite_pattern_table_address)
-        i = 0
-        while i < self._spr_ram.size:
-            s = self._spr_ram[i:i + 4]
-            x = s[3]
-            y = s[0] + 1
-            tail_index = s[1] * 16
-            tail_data = pattern_table[tail_index:tail_index + 16]
-            attribute = s[2]
-            palette = self._sprite_palette_from_oam(attribute)
-            if 0 < x < 256 and 0 < y < 240:
-                self.draw_tile((x, y), tail_data, palette)
-            i += 4
-
-    def draw_background(self):
-        """
-        pattern table 8KB 相当于存了两张 128 * 128 的图片
-
-        0               4K              8K
-            128 * 128       128 * 128
-
-        tile 8 * 8 = 16B sprite 由多个 tile 组成
-        每个 pattern table 可以存 256 个 tail
-        每个 tail 16B 前 8B 低位 后 8B 高位 一个像素点可取得值 0(透明) 1 2 3
-
-        Name Tables $03C0  960 Byte
-        每字节控制
-        """
-        pattern_table = self._pattern_table_from_vram(self.background_pattern_table_address)
-        name_table = self._name_table_from_vram()
-        attribute_table = name_table[-64:]
-        i = 0
-        while i < 960:
-            tail_index = name_table[i]
-            start = tail_index * 16
-            end = start + 16
-            tail_data = pattern_table[start:end]
-            tail_x = (i % 32)
-            tail_y = math.floor(i / 32)
-            palette = self._background_palette_from_attribute_table(attribute_table, tail_x, tail_y)
-            self.draw_tile((tail_x * 8, tail_y * 8), tail_data, palette)
-            i += 1
-
-    def _background_palette_from_attribute_table(self, attribute_table, x, y):
-        """
-        根据坐标求出当前 tile 属于哪个 block
-        取出 block 在属性表中的 byte
-        根据坐标求出当前 tile 在 block 中的 index
-        用 index 取出调色板
-        """
-        attribute_index = math.ceil(x / 32) + math.ceil(y / 32) * 8
-        attribute_data = attribute_table[attribute_index]
-        tile_index = math.floor((x % 32) / 16) * 2 + math.floor((y % 32) / 16)
-        palette_index = (attribute_data >>
-                         ((0, 4, 2, 6)[tile_index])) & 0b11
-        palette = [palettes[self._ppu_bus.read_byte(0x3F00)]]
-        if palette_index == 0:
-            return palette + [palettes[self._ppu_bus.read_byte(0x3F01)], palettes[self._ppu_bus.read_byte(0x3F02)], palettes[self._ppu_bus.read_byte(0x3F03)]]
-        elif palette_index == 1:
-            return palette + [palettes[self._ppu_bus.read_byte(0x3F05)], palettes[self._ppu_bus.read_byte(0x3F06)], palettes[self._ppu_bus.read_byte(0x3F07)]]
-        elif palette_index == 2:
-            return palette + [palettes[self._ppu_bus.read_byte(0x3F09)], palettes[self._ppu_bus.read_byte(0x3F0A)], palettes[self._ppu_bus.read_byte(0x3F0B)]]
-        elif palette_index == 3:
-            return palette + [palettes[self._ppu_bus.read_byte(0x3F0D)], palettes[self._ppu_bus.read_byte(0x3F0E)], palettes[self._ppu_bus.read_byte(0x3F0F)]]
+    def _setup_planes(self, compositor):
+        """
+        背景, sprite 和 sprite 优先级三张平面, 每帧结束时由 compositor 合成, 见 compositor.py
+        平面会被 numpy 直接引用, 只能按切片原地修改, 不能改变长度
+        """
+        self._background_plane = bytearray(256 * 240)
+        self._sprite_plane = bytearray(256 * 240)
+        self._priority_plane = bytearray(256 * 240)
+        # 这一帧画过 sprite 的扫描线
+        self._sprite_lines = set()
+        self._compositor = create_compositor(
+            compositor, self._background_plane, self._sprite_plane, self._priority_plane)
+
+    def _setup_sprites(self):
+        """
+        sprite 按扫描线分组
+            OAM 或者 sprite 大小改变之后, 第一次用到时把 64 个 sprite 分到它们覆盖的扫描线,
+            每条扫描线最多 MAX_LINE_SPRITES 个, 按 OAM 顺序, 所以 sprite 0 如果在这条线上一定是第一个
+            渲染扫描线时只看这条线自己的列表
+        """
+        self._sprites_dirty = True
+        self._sprite_bins = None
+        self._sprite_bin_height = 0
+        # 第一条超过 8 个 sprite 的扫描线, 没有是 -1
+        self._overflow_line = -1
+        # sprite 0 hit 发生的位置 (scanline * 341 + cycle), 没有是 -1
+        self._sprite_0_dot = -1
+        # 预测 sprite 0 hit 的第一个和最后一个位置, 见 _predict_sprite_0_hit
+        self._sprite_0_checks = (-1, -1)
+
+    def _line_sprites(self, line):
+        """
+        第 line 条扫描线上的 sprite 编号
+        """
+        height = self.sprite_size
+        if self._sprites_dirty or height != self._sprite_bin_height:
+            self._evaluate_sprites(height)
+        return self._sprite_bins[line]
+
+    def _evaluate_sprites(self, height):
+        bins = [[] for _ in range(VISIBLE_LINES)]
+        overflow = -1
+        data = self._spr_ram.data
+        for index in range(64):
+            # OAM 里的 y 比 sprite 第一行所在的扫描线小 1
+            top = data[index * 4] + 1
+            for line in range(top, min(top + height, VISIBLE_LINES)):
+                sprites = bins[line]
+                if len(sprites) < MAX_LINE_SPRITES:
+                    sprites.append(index)
+                elif overflow < 0 or line < overflow:
+                    overflow = line
+        self._sprite_bins = bins
+        self._sprite_bin_height = height
+        self._overflow_line = overflow
+        self._sprites_dirty = False
+
+        # sprite 0 覆盖的每条扫描线都在上一条线的 cycle 257 预测, 第 0 条在 pre-render 预测,
+        # 后面紧跟着帧结束事件, 不用另外的事件
+        top = max(data[0] + 1, 1)
+        bottom = min(data[0] + 1 + height, VISIBLE_LINES)
+        if top < bottom:
+            self._sprite_0_checks = ((top - 1) * 341 + RENDER_CYCLE, (bottom - 2) * 341 + RENDER_CYCLE)
+        else:
+            self._sprite_0_checks = (-1, -1)
+
+    def _next_sprite_0_check(self, position):
+        """
+        position 之后下一个预测 sprite 0 hit 的位置, 没有返回 -1
+        预测之前 PPU 还不知道 hit 的位置, 所以预测本身也要是 CPU 能看到的事件,
+        否则 CPU 会一直执行 (或者空转跳过) 到 vblank, 错过 hit
+        """
+        if self._status & 0x40:
+            return -1
+        if self._sprites_dirty or self.sprite_size != self._sprite_bin_height:
+            self._evaluate_sprites(self.sprite_size)
+        first, last = self._sprite_0_checks
+        if position >= last:
+            return -1
+        elif position < first:
+            return first
+        line, cycle = divmod(position, 341)
+        if cycle < RENDER_CYCLE:
+            return line * 341 + RENDER_CYCLE
+        return (line + 1) * 341 + RENDER_CYCLE
+
+    def _next_overflow_dot(self, position):
+        """
+        position 之后设置 sprite overflow 标志的位置, 没有返回 -1
+        标志在 _render_sprites 里设置, 也要是 CPU 能看到的事件, 否则轮询 $2002 的空转循环会被跳过到 vblank
+        """
+        if self._status & 0x20 or not self._rendering_enabled():
+            return -1
+        if self._sprites_dirty or self.sprite_size != self._sprite_bin_height:
+            self._evaluate_sprites(self.sprite_size)
+        if self._overflow_line < 0:
+            return -1
+        dot = self._overflow_line * 341 + RENDER_CYCLE
+        return dot if position < dot else -1
+
+    def _sprite_row(self, index, line):
+        """
+        第 index 个 sprite 在第 line 条扫描线上的一行
+
+        :return: x, 8 个像素的 2 位下标 (已经按水平翻转处理), attribute
+        """
+        data = self._spr_ram.data
+        y, tile, attribute, x = data[index * 4:index * 4 + 4]
+        height = self._sprite_bin_height
+        row = line - y - 1
+        if attribute & 0x80:
+            # 垂直翻转, 8 * 16 时上下两个 tile 也交换
+            row = height - 1 - row
+        if height == 16:
+            # 8 * 16 的 pattern table 由 tile 的第 0 位决定, 上半是偶数 tile, 下半是下一个
+            base = (tile & 0x01) << 11
+            tile = (tile & 0xFE) + (row >> 3)
+            row &= 0x07
         else:
-            raise RuntimeError('palette_index', palette_index)
-
-    def draw_tile(self, position, data, palette):
-        sx, sy = position
-        y = 0
-        while y < 8:
-            byte_low = data[y]
-            byte_high = data[y + 8]
-            x = 0
-            while x < 8:
-                c1 = (byte_low >> (7 - x)) & 1
-                c2 = (byte_high >> (7 - x)) & 1
-                i = (c2 << 1) + c1
-                color = palette[i]
-                px = sx + x
-                py = sy + y
-                index = py * 256 + px
-                if 0 < px < 256 and 0 < py < 240:
-                    self.frame_buffer[index] = color
-                x += 1
-            y += 1
+            base = self.sprite_pattern_table_address >> 1
+        rows = self._ppu_bus.flipped_tile_rows if attribute & 0x40 else self._ppu_bus.tile_rows
+        return x, rows[base + tile * 8 + row], attribute
+
+    def _render_sprites(self, line):
+        """
+        把这条扫描线上的 sprite 画到 sprite 平面
+        编号小的 sprite 优先, 从后往前画, 前面的覆盖后面的, 包括它的优先级位
+        """
+        plane = self._sprite_plane
+        start = line * 256
+        if line in self._sprite_lines:
+            # 上一帧留下的 sprite
+            plane[start:start + 256] = _EMPTY_LINE
+            self._sprite_lines.discard(line)
+        if not self._rendering_enabled():
+            return
+
+        sprites = self._line_sprites(line)
+        if line == self._overflow_line:
+            self._set_sprite_overflow()
+        if not sprites or not self.show_sprite or not self._drawing:
+            return
+
+        self._sprite_lines.add(line)
+        priority = self._priority_plane
+        left = 0 if self.show_sprite_left else 8
+        for index in reversed(sprites):
+            x, row, attribute = self._sprite_row(index, line)
+            pixels = row.translate(_PALETTE_TRANSLATIONS[4 + (attribute & 0x03)])
+            behind = (attribute >> 5) & 1
+            position = start + x
+            for i, pixel in enumerate(pixels):
+                if pixel and left <= x + i < 256:
+                    plane[position + i] = pixel
+                    priority[position + i] = behind
+
+    def _predict_sprite_0_hit(self, line):
+        """
+        在上一条扫描线画完 (v 已经指向 line) 时算出 sprite 0 hit 在 line 上的位置,
+        作为一个 CPU 能看到的事件, 轮询 $2002 的游戏在正确的周期看到标志
+        x = 255 和被裁掉的左边 8 个像素不会 hit
+        """
+        if self._status & 0x40 or not (self.show_background and self.show_sprite):
+            return
+        sprites = self._line_sprites(line)
+        if not sprites or sprites[0] != 0:
+            return
+
+        x, row, _ = self._sprite_row(0, line)
+        background = self._background_pixels()
+        left = 0 if self.show_background_left and self.show_sprite_left else 8
+        for i, pixel in enumerate(row):
+            sx = x + i
+            if sx >= 255:
+                break
+            if pixel and sx >= left and background[sx] & 0x03:
+                self._sprite_0_dot = line * 341 + sx + 1
+                return
+
+    def _rendering_enabled(self):
+        return self._mask & 0x18 != 0
+
+    def _increment_y(self):
+        """
+        v 的 fine y 加 1, 满 8 行进到下一行 tile, 第 29 行之后切换垂直方向的 nametable
+        http://wiki.nesdev.com/w/index.php/PPU_scrolling#Wrapping_around
+        """
+        v = self._vram_address
+        if (v & 0x7000) != 0x7000:
+            v += 0x1000
+        else:
+            v &= 0x0FFF
+            coarse_y = (v & 0x03E0) >> 5
+            if coarse_y == 29:
+                coarse_y = 0
+                v ^= 0x0800
+            elif coarse_y == 31:
+                coarse_y = 0
+            else:
+                coarse_y += 1
+            v = (v & 0x7C1F) | (coarse_y << 5)
+        self._vram_address = v
+
+    def _copy_horizontal(self):
+        """
+        把 t 的 coarse x 和水平 nametable 复制到 v
+        """
+        self._vram_address = (self._vram_address & 0x7BE0) | (self._tmp_vram_address & 0x041F)
+
+    def _setup_background_layers(self):
+        """
+        背景层
+            vram 里每个 1KB 的 nametable 都预先画成一张 256 * 240 的图, 每个像素是调色板下标 0 - 15
+            扫描线从背景层按 scroll 切出 256 个像素, 不用每帧重新解码 960 个 tile
+            写 nametable 标记对应的 tile, 写 attribute 标记它管的 4 * 4 个 tile,
+            颜色在合成扫描线时才查, 调色板改变不用重画
+            背景 pattern table ($0000 / $1000) 各有一组背景层, 一帧中间切换 pattern table 只是换一组用
+        """
+        self._layers = [[bytearray(256 * 240) for _ in range(4)] for _ in range(2)]
+        # 每个背景层需要重画的 tile 下标 0 - 959
+        self._dirty_tiles = [[set(range(960)) for _ in range(4)] for _ in range(2)]
+        # 每组 pattern table 里内容变了的 tile 号 0 - 255, 用到这组背景层时只重画 nametable 里用这些 tile 的位置
+        self._dirty_patterns = [set(), set()]
+
+    def mark_name_table_dirty(self, offset):
+        """
+        PPUBus 写 nametable 时调用
+
+        :param offset: vram 里的偏移 0 - 0xFFF
+        """
+        table = offset >> 10
+        index = offset & 0x3FF
+        for dirty_tiles in self._dirty_tiles:
+            dirty = dirty_tiles[table]
+            if index < 960:
+                dirty.add(index)
+            else:
+                # attribute 每个字节管 4 * 4 个 tile
+                x = ((index - 960) & 0x07) * 4
+                y = ((index - 960) >> 3) * 4
+                for row in range(y, min(y + 4, 30)):
+                    dirty.update(range(row * 32 + x, row * 32 + x + 4))
+
+    def mark_pattern_dirty(self, address, size):
+        """
+        mapper 切换了 CHR bank 或者写了 CHR-RAM, 记下 address 开始 size 字节里的 tile 号
+        CHR-RAM 可能一次被写几千个字节, 这里只做标记, 用到背景层时才去 nametable 里找
+        sprite 每条扫描线直接从 tile_rows 取, 不用处理
+        """
+        first = (address >> 4) & 0xFF
+        last = ((address + size - 1) >> 4) & 0xFF
+        self._dirty_patterns[(address >> 12) & 0x01].update(range(first, last + 1))
+
+    def _mark_pattern_tiles(self, pattern_table):
+        """
+        把 nametable 里用到变了的 tile 的位置标记为要重画
+        用 translate 把这些 tile 号换成 1, 再用 find 找出位置, 不用在 Python 里逐个比较 960 个字节
+        """
+        patterns = self._dirty_patterns[pattern_table]
+        marks = bytearray(256)
+        for tile in patterns:
+            marks[tile] = 1
+        patterns.clear()
+        for table, dirty in enumerate(self._dirty_tiles[pattern_table]):
+            name_table = self._ppu_bus.read_name_table(0x2000 + table * 0x400)
+            hits = bytes(name_table[:960]).translate(marks)
+            index = hits.find(1)
+            while index >= 0:
+                dirty.add(index)
+                index = hits.find(1, index + 1)
+
+    def _update_layer(self, pattern_table, table):
+        """
+        重画背景层里标记过的 tile
+        """
+        dirty = self._dirty_tiles[pattern_table][table]
+        name_table = self._ppu_bus.read_name_table(0x2000 + table * 0x400)
+        attribute_table = name_table[960:]
+        rows = self._ppu_bus.tile_rows
+        base = pattern_table << 11
+        layer = self._layers[pattern_table][table]
+        for index in dirty:
+            tile_y, tile_x = divmod(index, 32)
+            attribute = attribute_table[(tile_y >> 2) * 8 + (tile_x >> 2)]
+            palette = (attribute >> (((tile_y << 1) & 0x04) | (tile_x & 0x02))) & 0x03
+            translation = _PALETTE_TRANSLATIONS[palette]
+            start = base + name_table[index] * 8
+            position = tile_y * 8 * 256 + tile_x * 8
+            for y in range(8):
+                layer[position:position + 8] = rows[start + y].translate(translation)
+                position += 256
+        dirty.clear()
+
+    def _layer(self, pattern_table, index):
+        """
+        用第 pattern_table 个 pattern table 画的第 index 个 nametable 的背景层, 先重画标记过的 tile
+        """
+        if self._dirty_patterns[pattern_table]:
+            self._mark_pattern_tiles(pattern_table)
+        table = self._ppu_bus.physical_name_table(index)
+        if self._dirty_tiles[pattern_table][table]:
+            self._update_layer(pattern_table, table)
+        return self._layers[pattern_table][table]
+
+    def _background_line(self):
+        """
+        按 v 和 fine x 取出一条扫描线的 256 个背景像素
+        tile 行来自预先解码的 tile_rows, 每个 tile 只做一次 translate 加上调色板
+
+        :return: 每个像素的调色板下标 0 - 15, 低 2 位为 0 的是透明
+        """
+        read_byte = self._ppu_bus.read_byte
+        rows = self._ppu_bus.tile_rows
+        base = (self.background_pattern_table_address >> 1) + ((self._vram_address >> 12) & 0x07)
+        v = self._vram_address
+        # fine x 不为 0 时要多取一个 tile
+        pixels = bytearray()
+        for _ in range(33):
+            tile = read_byte(0x2000 | (v & 0x0FFF))
+            attribute = read_byte(0x23C0 | (v & 0x0C00) | ((v >> 4) & 0x38) | ((v >> 2) & 0x07))
+            palette = (attribute >> (((v >> 4) & 0x04) | (v & 0x02))) & 0x03
+            pixels += rows[base + tile * 8].translate(_PALETTE_TRANSLATIONS[palette])
+            # coarse x 加 1, 满 32 切换水平方向的 nametable
+            if (v & 0x001F) == 31:
+                v = (v & 0x7FE0) ^ 0x0400
+            else:
+                v += 1
+        return pixels[self._fine_x:self._fine_x + 256]
+
+    def _background_pixels(self):
+        """
+        从背景层切出当前扫描线的 256 个像素, 超出 nametable 右边的部分来自水平方向的下一个 nametable
+        coarse y 在 30 和 31 时 v 指向 attribute 区域, 这种少见的情况直接按 tile 取
+        """
+        v = self._vram_address
+        coarse_y = (v >> 5) & 0x1F
+        if coarse_y >= 30:
+            return self._background_line()
+
+        pattern_table = self.background_pattern_table_address >> 12
+        index = (v >> 10) & 0x03
+        start = (coarse_y * 8 + ((v >> 12) & 0x07)) * 256
+        x = (v & 0x1F) * 8 + self._fine_x
+        pixels = self._layer(pattern_table, index)[start + x:start + 256]
+        if x:
+            pixels += self._layer(pattern_table, index ^ 0x01)[start:start + x]
+        return pixels
+
+    def _render_line(self, line):
+        """
+        在可见扫描线的 cycle 257 画出这一行, 用的是这时候的 v 和 fine x,
+        所以一帧中间改 scroll (比如 mario 的状态栏) 能正确显示, 一帧中间改调色板也一样
+        """
+        if line == 0 or self._palettes_dirty:
+            self._snapshot_palettes(line)
+        self._render_sprites(line)
+        start = line * 256
+        plane = self._background_plane
+        if not self._rendering_enabled():
+            plane[start:start + 256] = _EMPTY_LINE
+            return
+
+        if self._drawing:
+            if self.show_background:
+                plane[start:start + 256] = self._background_pixels()
+                if not self.show_background_left:
+                    plane[start:start + 8] = _EMPTY_LINE[:8]
+            else:
+                plane[start:start + 256] = _EMPTY_LINE
+
+        self._increment_y()
+        self._copy_horizontal()
+        if line + 1 < VISIBLE_LINES:
+            self._predict_sprite_0_hit(line + 1)
+        if self._mapper is not None:
+            self._mapper.clock_scanline()
+
+    def compose(self):
+        """
+        合成背景和 sprite, 换算成 NES 颜色下标放进 frame_buffer
+        每帧结束时自动调用, 也可以单独调用来测试合成的耗时
+        """
+        if not self._line_colors:
+            # 还没有画过扫描线
+            self._snapshot_palettes(0)
+        self.frame_buffer = self._compositor.compose(self._line_colors, self._sprite_lines)
+        self.emphasis = (self._mask >> 5) & 0x07
 
     def log(self):
         return [
@@ -448,32 +837,28 @@ class PPU:
             self._write_toggle,
         ]
 
-    def _update_vblank_status(self):
-        if self._scanline == 241 and self._cycle == 1:
-            self._set_vblank_status()
-            if self.nmi_enabled:
-                self._trigger_nmi()
+    def _enter_vblank(self):
+        self._set_vblank_status()
+        if self.nmi_enabled:
+            self._trigger_nmi()
 
-        if self._scanline == 261 and self._cycle == 1:
-            self._clear_vblank_status()
-            self._clear_sprite_0_hit()
-            self._clear_sprite_overflow()
-
-    def _update_cycle(self):
-        self._cycle += 1
-
-        if self._cycle > 340:
-            self._cycle = 0
-            self._scanline += 1
-            if self._scanline > 261:
-                self._scanline = 0
-                self._frame += 1
-                # log('frame', self._frame)
-                self.frame_ready = True
-                self.draw_background()
-                self.draw_sprite()
-
-        self._update_vblank_status()
+    def _enter_pre_render(self):
+        self._clear_vblank_status()
+        self._clear_sprite_0_hit()
+        self._clear_sprite_overflow()
+
+    def _finish_frame(self):
+        self._frame += 1
+        # log('frame', self._frame)
+        if self._drawing:
+            self.frame_ready = True
+            # 背景和 sprite 已经按扫描线画好了
+            self.compose()
+            self._skipped_frames = 0
+        else:
+            self._skipped_frames += 1
+        self._drawing = self._skipped_frames >= self.frameskip and not self.skip_next_frame
+        self.skip_next_frame = False
 
     def tick(self):
         """
@@ -481,7 +866,113 @@ class PPU:
         1 scanline 341 PPU cycles
         1 cycle 1 pixel
         """
-        self._update_cycle()
+        self.run(1)
 
-        if (not self.show_background) and (not self.show_sprite):
-            return
+    def _next_irq_dot(self, position):
+        """
+        mapper 扫描线 IRQ 的位置, 假设渲染一直开着, 不在这一帧里时返回 -1
+        扫描线计数在可见扫描线的 RENDER_CYCLE 和 COPY_VERTICAL_DOT, 和 _render_line 一致
+        渲染开关改变要写 $2001, 那时 PPU 已经追上, 下一次计算会用新的状态
+        """
+        if self._mapper is None or not self._rendering_enabled():
+            return -1
+        clocks = self._mapper.clocks_until_irq()
+        if clocks < 0:
+            return -1
+        # 下一次计数是第几条扫描线, pre-render 算第 240 次
+        if position < LAST_RENDER_DOT:
+            line, cycle = divmod(position, 341)
+            first = line + 1 if cycle >= RENDER_CYCLE else line
+        elif position < COPY_VERTICAL_DOT:
+            first = VISIBLE_LINES
+        else:
+            return -1
+        line = first + clocks - 1
+        if line < VISIBLE_LINES:
+            return line * 341 + RENDER_CYCLE
+        elif line == VISIBLE_LINES:
+            return COPY_VERTICAL_DOT
+        return -1
+
+    def _next_event(self, position):
+        if position < self._sprite_0_dot:
+            return self._sprite_0_dot
+        if position < VBLANK_DOT:
+            event = VBLANK_DOT
+        elif position < PRE_RENDER_DOT:
+            event = PRE_RENDER_DOT
+        else:
+            event = FRAME_DOTS
+        check = self._next_sprite_0_check(position)
+        if check >= 0:
+            event = check
+        overflow = self._next_overflow_dot(position)
+        if 0 <= overflow < event:
+            event = overflow
+        irq = self._next_irq_dot(position)
+        if 0 <= irq < event:
+            event = irq
+        return event
+
+    def dots_until_event(self):
+        """
+        距离下一个事件 (sprite 0 hit 和它的预测, sprite overflow, mapper 的 IRQ, vblank, pre-render, 帧结束) 的 PPU 周期数
+        """
+        position = self._scanline * 341 + self._cycle
+        return self._next_event(position) - position
+
+    def _next_dot(self, position):
+        """
+        PPU 内部下一个要处理的位置, 除了事件还有每条可见扫描线的渲染
+        """
+        if position < self._sprite_0_dot:
+            # sprite 0 hit 在可见扫描线的 cycle 1 - 255, 不会和其他位置重合
+            return self._sprite_0_dot
+        elif position < LAST_RENDER_DOT:
+            line, cycle = divmod(position, 341)
+            if cycle < RENDER_CYCLE:
+                return line * 341 + RENDER_CYCLE
+            return (line + 1) * 341 + RENDER_CYCLE
+        elif PRE_RENDER_DOT <= position < COPY_VERTICAL_DOT:
+            return COPY_VERTICAL_DOT
+        return self._next_event(position)
+
+    def _process_dot(self, position):
+        if position == self._sprite_0_dot:
+            self._sprite_0_dot = -1
+            if self.show_background and self.show_sprite:
+                self._set_sprite_0_hit()
+        elif position < VBLANK_DOT:
+            self._render_line(position // 341)
+        elif position == VBLANK_DOT:
+            self._enter_vblank()
+        elif position == PRE_RENDER_DOT:
+            self._enter_pre_render()
+        elif position == COPY_VERTICAL_DOT:
+            if self._rendering_enabled():
+                self._vram_address = self._tmp_vram_address
+                # 下一帧第 0 条扫描线的 sprite 0 hit, 位置在帧结束之后
+                self._predict_sprite_0_hit(0)
+                if self._mapper is not None:
+                    self._mapper.clock_scanline()
+
+    def run(self, dots):
+        """
+        一次推进 dots 个 PPU 周期, 结果和调用 dots 次 tick 相同
+        中间只在事件点和每条可见扫描线的 cycle 257 做处理
+        """
+        position = self._scanline * 341 + self._cycle
+        target = position + dots
+        dot = self._next_dot(position)
+        while dot <= target:
+            if dot == FRAME_DOTS:
+                target -= FRAME_DOTS
+                dot = 0
+                self._scanline = 0
+                self._cycle = 0
+                self._finish_frame()
+            else:
+                self._scanline, self._cycle = divmod(dot, 341)
+                self._process_dot(dot)
+            dot = self._next_dot(dot)
+        self._scanline, self._cycle = divmod(target, 341)
@@ -0,0 +1,372 @@
+import re
+
+from alu import TABLES
+from codegen import describe, has_penalty, is_control_flow, instruction_lines
+
+
+# 块里用局部变量代替 CPU 的寄存器, 块结束时再写回
+_REGISTERS = [
+    ('cpu._accumulator', 'reg_a'),
+    ('cpu._register_x', 'reg_x'),
+    ('cpu._register_y', 'reg_y'),
+    ('cpu._stack_pointer', 'reg_sp'),
+    ('cpu._flag_c', 'flag_c'),
+    ('cpu._flag_i', 'flag_i'),
+    ('cpu._flag_d', 'flag_d'),
+    ('cpu._flag_b', 'flag_b'),
+    ('cpu._flag_v', 'flag_v'),
+    ('cpu._nz', 'reg_nz'),
+]
+
+_STATUS = ('(flag_c | (0 if reg_nz & 0xFF else 2) | (flag_i << 2) | (flag_d << 3) | '
+           '(flag_b << 4) | 0x20 | (flag_v << 6) | (0x80 if reg_nz & 0x8080 else 0))')
+
+# 会读写 address 的指令, jmp jsr 的 address 是跳转地址
+_READS = ('lda', 'ldx', 'ldy', 'and', 'ora', 'eor', 'cmp', 'cpx', 'cpy', 'adc', 'sbc', 'bit',
+          'inc', 'dec', 'asl', 'lsr', 'rol', 'ror')
+_WRITES = ('sta', 'stx', 'sty', 'inc', 'dec', 'asl', 'lsr', 'rol', 'ror')
+# 写栈的指令
+_PUSHES = ('pha', 'php', 'jsr', 'brk')
+# 可能清掉 I 标志的指令, 等着的 IRQ 要在它之后马上处理
+_INTERRUPT_FLAG = ('cli', 'plp')
+
+# 每个块最多的指令数
+MAX_BLOCK_INSTRUCTIONS = 32
+# 一个 pc 解释执行多少次之后才编译, 编译一个块的时间够解释执行几百条指令, 很少执行的代码不值得编译
+HOT_BLOCK_COUNT = 16
+
+
+def _is_plain(address, write):
+    """
+    读写这个地址不会碰到 PPU、IO 和 mapper
+    """
+    if address < 0x2000 or 0x6000 <= address < 0x8000:
+        return True
+    return address >= 0x8000 and not write
+
+
+def _ram_index(argument, mode, operands):
+    """
+    read_byte(argument) 或 write_byte(argument, ...) 一定访问内部 RAM 时,
+    返回 RAM 里的下标表达式和可能访问的 RAM 页 (0 - 7), 否则返回 None
+    栈、零页和间接寻址的指针都在 RAM 里, 绝对寻址在编译时就知道是不是 RAM
+    """
+    if argument.startswith('0x100 + '):
+        return argument, {1}
+    if mode in ('inx', 'iny') and argument in ('pointer', '(pointer + 1) & 0xFF'):
+        return argument, {0}
+    if argument != 'address':
+        return None
+    if mode in ('zp', 'zp_x', 'zp_y'):
+        return argument, {0}
+    if mode == 'abs':
+        word = int(operands['word'], 16)
+        if word < 0x2000:
+            return hex(word & 0x7FF), {(word >> 8) & 0x07}
+    elif mode in ('abs_x', 'abs_y', 'abs_x_write', 'abs_y_write'):
+        first = int(operands['word'], 16)
+        last = first + 0xFF
+        pages = {(first >> 8) & 0x07, (last >> 8) & 0x07}
+        if last < 0x800:
+            return argument, pages
+        elif last < 0x2000:
+            return 'address & 0x7FF', pages
+    return None
+
+
+def _call_arguments(line, start):
+    """
+    line[start] 是函数调用的左括号
+    :return: 顶层的参数列表, 右括号之后的位置
+    """
+    arguments = []
+    depth = 0
+    begin = start + 1
+    for end in range(start, len(line)):
+        char = line[end]
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                arguments.append(line[begin:end].strip())
+                return arguments, end + 1
+        elif char == ',' and depth == 1:
+            arguments.append(line[begin:end].strip())
+            begin = end + 1
+    raise RuntimeError('括号不匹配 {}'.format(line))
+
+
+def _inline_ram(line, mode, operands, code_pages):
+    """
+    把 line 里访问 RAM 的 read_byte(...) 换成 ram[...], 省掉函数调用和查页表
+    整行是 write_byte(...) 并且写的页上没有重编译的代码时, 也换成 ram[...] = ..., 有代码的页要经过总线通知 recompiler
+    """
+    indent = line[:len(line) - len(line.lstrip())]
+    if line.lstrip().startswith('write_byte('):
+        start = line.index('(')
+        (address, value), end = _call_arguments(line, start)
+        index = _ram_index(address, mode, operands)
+        if index is not None and not index[1] & code_pages:
+            return '{}ram[{}] = {}'.format(indent, index[0], value)
+        return line
+    start = 0
+    while True:
+        start = line.find('read_byte(', start)
+        if start < 0:
+            return line
+        (address,), end = _call_arguments(line, start + len('read_byte'))
+        index = _ram_index(address, mode, operands)
+        if index is None:
+            start = end
+        else:
+            replacement = 'ram[{}]'.format(index[0])
+            line = line[:start] + replacement + line[end:]
+            start += len(replacement)
+
+
+class Recompiler:
+    """
+    基本块动态重编译
+
+    把从 pc 开始的一段 6502 指令翻译成一个 Python 函数 (生成源码再 compile), 按 pc 缓存
+    块函数用局部变量保存寄存器, 一次调用执行整个块, 返回消耗的周期
+
+    块在下面这些地方结束
+        跳转、分支、子程序调用和返回、BRK RTI
+        CLI PLP, 之后可能要处理等着的 IRQ
+        可能访问 PPU 或 IO 的指令, 它是块的最后一条, 执行前先把周期写回 CPU,
+        这样总线上的 catch-up 拿到的时间和逐条解释时一样
+        RAM 里的块遇到写内存的指令, 写的可能就是这个块自己
+
+    周期预算
+        CPU.run 在每条指令之前检查预算, 块不在指令之间检查, 只在开头检查一次:
+        除了最后一条, 前面的指令最多消耗的周期 (加上跨页和分支的周期) 小于 limit 时, 整个块一定都会执行,
+        否则这一次只解释执行一条指令, 行为和 CPU.run 逐条执行相同
+
+    只编译 PRG-ROM ($8000-$FFFF) 和内部 RAM ($0000-$1FFF) 里的代码, 一个 pc 执行 HOT_BLOCK_COUNT 次之后才编译,
+    之前解释执行
+    RAM 里的块在对应的 RAM 被写的时候作废
+    """
+    def __init__(self, cpu, bus):
+        self._cpu = cpu
+        self._bus = bus
+        self._instruction_set = cpu.instruction_set
+        # pc -> 块函数
+        self.blocks = [None] * 0x10000
+        # pc -> 还没有编译时解释执行的次数
+        self._counts = bytearray(0x10000)
+        # opcode -> 是否结束一个块, 解释执行一个块时用
+        self._ends_block = [False] * 256
+        for opcode, instruction in self._instruction_set.items():
+            name = describe(instruction)[0]
+            self._ends_block[opcode] = is_control_flow(name) or name in _INTERRUPT_FLAG
+        # RAM 地址 ($0000-$07FF) -> 覆盖这个地址的块的 pc
+        self._ram_code = {}
+        # 有重编译的代码的 RAM 页 (0 - 7), 块里写这些页要经过总线
+        self._code_pages = set()
+        self._bus.connect_to_recompiler(self)
+
+    def _interpret(self, limit):
+        return self._cpu.emulate()
+
+    def _interpret_block(self, limit):
+        """
+        逐条解释执行一个还没有编译的块, 在编译的块会结束的地方结束, 这样只有块的开头会被计数
+        访问 IO 之后有 NMI、DMA 或者 end_run 时 _pending 为真, 和编译的块一样回到 CPU.run 处理
+        """
+        cpu = self._cpu
+        emulate = cpu.emulate
+        ends_block = self._ends_block
+        cycles = 0
+        while True:
+            cycles += emulate()
+            if ends_block[cpu._opcode] or cpu._pending or cycles >= limit:
+                return cycles
+
+    def compile(self, pc):
+        """
+        编译从 pc 开始的块, 不能编译的地址用解释执行代替
+        执行的次数还不够时这一次解释执行整个块, 不缓存, 下一次再来计数
+        """
+        count = self._counts[pc]
+        if count < HOT_BLOCK_COUNT:
+            self._counts[pc] = count + 1
+            return self._interpret_block
+        block = None
+        if pc >= 0x8000 or pc < 0x2000:
+            block = self._compile_block(pc)
+        if block is None:
+            block = self._interpret
+        self.blocks[pc] = block
+        return block
+
+    def _read_operands(self, pc, length):
+        read_byte = self._bus.read_byte
+        if length == 1:
+            return {}
+        byte = read_byte((pc + 1) & 0xFFFF)
+        operands = {
+            'byte': hex(byte),
+            'offset': str(byte - 256 if byte > 127 else byte),
+        }
+        if length == 3:
+            operands['word'] = hex(byte | (read_byte((pc + 2) & 0xFFFF) << 8))
+        return operands
+
+    def _may_access_io(self, name, mode, operands):
+        if name in _PUSHES or name not in _READS + _WRITES:
+            # 栈在 RAM 里, 跳转目标不是访问的地址
+            return mode == 'ind'
+        write = name in _WRITES
+        if mode in ('imm', 'imp', 'zp', 'zp_x', 'zp_y'):
+            return False
+        elif mode == 'abs':
+            return not _is_plain(int(operands['word'], 16), write)
+        elif mode in ('abs_x', 'abs_y', 'abs_x_write', 'abs_y_write'):
+            base = int(operands['word'], 16)
+            return not all(_is_plain((base + i) & 0xFFFF, write) for i in range(256))
+        else:
+            # 间接寻址在编译时不知道地址
+            return True
+
+    def _instructions(self, start):
+        """
+        :return: 块里的指令 (pc, name, mode, length, cycles, operands, io)
+        """
+        in_ram = start < 0x2000
+        read_byte = self._bus.read_byte
+        instructions = []
+        pc = start
+        while len(instructions) < MAX_BLOCK_INSTRUCTIONS:
+            instruction = self._instruction_set.get(read_byte(pc))
+            if instruction is None:
+                break
+            name, mode, length, cycles = describe(instruction)
+            # 不跨出 PRG-ROM 或 RAM
+            if (pc + length - 1 >= 0x10000) or (in_ram and pc + length - 1 >= 0x2000):
+                break
+            operands = self._read_operands(pc, length)
+            io = self._may_access_io(name, mode, operands)
+            instructions.append((pc, name, mode, length, cycles, operands, io))
+            pc += length
+            if io or is_control_flow(name) or name in _INTERRUPT_FLAG:
+                break
+            if in_ram and (name in _WRITES or name in _PUSHES):
+                break
+        return instructions
+
+    def _block_source(self, start, instructions):
+        body = []
+        last = len(instructions) - 1
+        # 最后一条指令之前最多消耗的周期
+        prefix = 0
+        for pc, name, mode, length, cycles, operands, io in instructions[:-1]:
+            prefix += cycles + (2 if has_penalty(name, mode) else 0)
+        # RAM 里的块写的可能是自己, 写 RAM 都经过总线
+        code_pages = self._code_pages if start >= 0x8000 else set(range(8))
+        # 基础周期在编译时累加, 只在要用到 cycles 的时候加一次, 运行时只加跨页和分支的周期
+        base_cycles = 0
+        for index, (pc, name, mode, length, cycles, operands, io) in enumerate(instructions):
+            next_pc = hex(pc + length)
+            if io:
+                body.extend([
+                    'cycles += {}'.format(base_cycles),
+                    'cpu._cycles += cycles - flushed',
+                    'flushed = cycles',
+                ])
+                base_cycles = 0
+            body.append('# {} {}'.format(hex(pc), name.upper()))
+            lines = instruction_lines(name, mode, operands, next_pc, 'cycles')
+            body.extend(_inline_ram(line, mode, operands, code_pages) for line in lines)
+            base_cycles += cycles
+            if index == last and not is_control_flow(name):
+                body.append('pc = {}'.format(next_pc))
+        body.append('cycles += {}'.format(base_cycles))
+
+        code = '\n'.join(body)
+        code = code.replace('cpu.status', _STATUS)
+        code = code.replace('cpu._program_counter', 'pc')
+        registers = []
+        for attribute, local in _REGISTERS:
+            if attribute in code or local in code:
+                code = code.replace(attribute, local)
+                registers.append((attribute, local))
+        # 只写回块里修改过的寄存器
+        assigned = set(re.findall(r'^\s*(\w+) [-+]?=', code, re.MULTILINE))
+
+        source = [
+            'def _build(cpu, read_byte, write_byte, read_word, ram, {}):'.format(', '.join(TABLES)),
+            '    def block_{:04x}(limit):'.format(start),
+        ]
+        if prefix:
+            source.extend([
+                '        if limit <= {}:'.format(prefix),
+                '            return cpu.emulate()',
+            ])
+        for attribute, local in registers:
+            source.append('        {} = {}'.format(local, attribute))
+        # 只有最后一条指令可能访问 IO, 执行前已经写回的周期是 flushed
+        io = instructions[-1][-1]
+        source.extend([
+            '        pc = {}'.format(hex(start)),
+            '        cycles = 0',
+        ])
+        if io:
+            source.append('        flushed = 0')
+        source.extend('        ' + line for line in code.split('\n'))
+        for attribute, local in registers:
+            if local in assigned:
+                source.append('        {} = {}'.format(attribute, local))
+        source.extend([
+            '        cpu._program_counter = pc',
+            '        cpu._cycles += cycles - flushed' if io else '        cpu._cycles += cycles',
+            '        return cycles',
+            '    return block_{:04x}'.format(start),
+        ])
+        return '\n'.join(source) + '\n'
+
+    def _compile_block(self, start):
+        instructions = self._instructions(start)
+        if not instructions:
+            return None
+        source = self._block_source(start, instructions)
+        namespace = {}
+        exec(compile(source, '<block {}>'.format(hex(start)), 'exec'), namespace)
+        bus = self._bus
+        block = namespace['_build'](self._cpu, bus.read_byte, bus.write_byte, bus.read_word, bus.ram, **TABLES)
+        if start < 0x2000:
+            self._watch(start, instructions)
+        return block
+
+    def _watch(self, start, instructions):
+        """
+        RAM 里的块要在被写时作废
+        有代码的页变多时, 已经编译的 ROM 块可能直接写这一页, 全部作废, 重新编译时写这一页会经过总线
+        """
+        pc, _, _, length, _, _, _ = instructions[-1]
+        pages = set()
+        for address in range(start, pc + length):
+            address &= 0x7FF
+            self._ram_code.setdefault(address, set()).add(start)
+            self._bus.mark_code(address)
+            pages.add(address >> 8)
+        if not pages <= self._code_pages:
+            self._code_pages |= pages
+            self.blocks[0x8000:] = [None] * 0x8000
+
+    def invalidate(self, address):
+        """
+        RAM 被写时调用, 作废覆盖这个地址的块
+        """
+        starts = self._ram_code.pop(address & 0x7FF, None)
+        if starts:
+            for start in starts:
+                self.blocks[start] = None
+
+    def invalidate_rom(self, start=0x8000, end=0x10000):
+        """
+        PRG-ROM 的 start - end 变了, 作废这一段的块, 以及从前面开始、可能延伸进来的块
+        """
+        first = max(start - MAX_BLOCK_INSTRUCTIONS * 3, 0x8000)
+        self.blocks[first:end] = [None] * (end - first)
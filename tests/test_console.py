@@ -0,0 +1,130 @@
+import os
+import tempfile
+import zlib
+
+from console import Console
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MARIO = os.path.join(ROOT, 'mario.nes')
+
+
+def _press(joypad, frame):
+    """
+    固定的按键序列: 按 start 开始游戏, 之后一直往右跑, 隔一段时间跳一下
+    """
+    (joypad.start.key_down if 60 <= frame < 66 else joypad.start.key_up)()
+    (joypad.right.key_down if frame >= 200 else joypad.right.key_up)()
+    (joypad.a.key_down if frame >= 260 and frame % 40 < 20 else joypad.a.key_up)()
+
+
+def _play(console, frames, run):
+    """
+    用 run 推进 console, 直到画完 frames 帧
+    :return: 最后的 CPU 周期和所有帧画面的校验和
+    """
+    ppu = console.ppu
+    checksum = 0
+    while ppu.frame < frames:
+        frame = ppu.frame
+        _press(console.joypad, frame)
+        while ppu.frame == frame:
+            run()
+        checksum = zlib.crc32(bytes(ppu.frame_buffer), checksum)
+    cycles = console.cpu.cycles
+    console.close()
+    return cycles, checksum
+
+
+def test_step_run_frame():
+    for dispatch in ('table', 'generated', 'recompiled'):
+        console = Console(MARIO, dispatch=dispatch, idle_skip=False)
+        stepped = _play(console, 300, console.step)
+        console = Console(MARIO, dispatch=dispatch, idle_skip=False)
+        assert _play(console, 300, console.run_frame) == stepped, dispatch
+
+
+def test_idle_skip():
+    for dispatch in ('table', 'generated', 'recompiled'):
+        console = Console(MARIO, dispatch=dispatch, idle_skip=False)
+        expected = _play(console, 300, console.run_frame)
+        console = Console(MARIO, dispatch=dispatch, idle_skip=True)
+        skipped = [0]
+
+        def run():
+            console.run_frame()
+            skipped[0] += console.skipped_cycles
+
+        assert _play(console, 300, run) == expected, dispatch
+        # 确实跳过了空转循环
+        assert skipped[0] > 0, dispatch
+
+
+def _poll_rom(first, last, flag):
+    """
+    生成一个 NROM 的 ROM, sprite first - last 在第 100 - 107 条扫描线上, x 是 99, 其他 sprite 在屏幕外
+    OAM 里除了 y 和 x 都是 $F0, nametable 全是 tile 0
+    打开渲染之后轮询 $2002 的 flag 位, 看到之后写 $8000, 让 CPU 在这条指令之后结束这一段, 然后停在 $C03E
+    """
+    code = [
+        0x78, 0xA2, 0xFF, 0x9A,                 # $C000 SEI LDX #$FF TXS
+        0x2C, 0x02, 0x20, 0x10, 0xFB,           # $C004 BIT $2002 BPL, 等两次 vblank
+        0x2C, 0x02, 0x20, 0x10, 0xFB,
+        0xA2, 0x00, 0xA9, 0xF0,                 # $C00E LDX #$00 LDA #$F0
+        0x9D, 0x00, 0x02, 0xE8, 0xD0, 0xFA,     # $C012 STA $0200,X INX BNE, 所有 sprite 放到屏幕外
+        0xA2, first * 4, 0xA9, 0x63,            # $C018 LDX #first*4 LDA #99
+        0x9D, 0x00, 0x02, 0x9D, 0x03, 0x02,     # $C01C STA $0200,X STA $0203,X
+        0xE8, 0xE8, 0xE8, 0xE8,                 # INX INX INX INX
+        0xE0, (last + 1) * 4, 0xD0, 0xF2,       # CPX #(last+1)*4 BNE $C01C
+        0xA9, 0x02, 0x8D, 0x14, 0x40,           # $C02A LDA #$02 STA $4014
+        0xA9, 0x18, 0x8D, 0x01, 0x20,           # $C02F LDA #$18 STA $2001
+        0xAD, 0x02, 0x20,                       # $C034 LDA $2002
+        0x29, flag, 0xF0, 0xF9,                 # AND #flag BEQ $C034
+        0x8D, 0x00, 0x80,                       # $C03B STA $8000
+        0x4C, 0x3E, 0xC0,                       # $C03E JMP $C03E
+    ]
+    prg = bytearray(0x4000)
+    prg[:len(code)] = bytes(code)
+    # reset 向量 $C000
+    prg[0x3FFC:0x3FFE] = bytes([0x00, 0xC0])
+    # 背景用的 tile 0 和 sprite 用的 tile $F0 每个像素都不透明
+    chr_ = bytearray(0x2000)
+    chr_[0x000:0x008] = bytes([0xFF] * 8)
+    chr_[0xF00:0xF08] = bytes([0xFF] * 8)
+    header = b'NES\x1a' + bytes([1, 1, 0, 0]) + bytes(8)
+    return header + bytes(prg) + bytes(chr_)
+
+
+def _poll(first, last, flag):
+    """
+    :return: 每种 dispatch 和 idle skip 下轮询结束时的 CPU 周期、扫描线和 PPU cycle
+    """
+    with tempfile.NamedTemporaryFile(suffix='.nes', delete=False) as f:
+        f.write(_poll_rom(first, last, flag))
+    try:
+        results = []
+        for dispatch in ('table', 'generated', 'recompiled'):
+            for idle_skip in (False, True):
+                console = Console(f.name, dispatch=dispatch, idle_skip=idle_skip)
+                while console.cpu.program_counter != 0xC03E:
+                    console.run_until_event()
+                ppu = console.ppu
+                results.append((console.cpu.cycles, ppu._scanline, ppu.cycle))
+                console.close()
+    finally:
+        os.remove(f.name)
+    return results
+
+
+def test_idle_skip_sprite_0_hit():
+    # 只有 sprite 0 在第 100 条扫描线上, 和不透明的背景重叠
+    results = _poll(0, 0, 0x40)
+    assert results[0][1] == 100
+    assert all(result == results[0] for result in results), results
+
+
+def test_idle_skip_sprite_overflow():
+    # sprite 1 - 9 在第 100 条扫描线上, sprite 0 在屏幕外, 标志在第 100 条扫描线的 cycle 257 设置
+    results = _poll(1, 9, 0x20)
+    assert results[0][1] == 100
+    assert all(result == results[0] for result in results), results
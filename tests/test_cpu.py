@@ -0,0 +1,132 @@
+import os
+
+import recompiler
+from cpu import CPU
+from ppu import PPU
+from joypad import Joypad
+from memory.ram import RAM
+from bus.cpu_bus import CPUBus
+from bus.ppu_bus import PPUBus
+from cartridge import Cartridge
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _build(dispatch):
+    """
+    没有 console 的 CPU 和总线, 卡带是 nestest
+    """
+    cartridge = Cartridge(os.path.join(ROOT, 'nestest.nes'))
+    cpu = CPU(dispatch)
+    ppu = PPU()
+    bus = CPUBus(cpu, ppu, RAM(0x800), RAM(0x2000), cartridge, Joypad(), RAM(0x20))
+    PPUBus(ppu, RAM(0x1000), cartridge, RAM(16), RAM(16))
+    cpu.reset()
+    return cpu, bus, cartridge
+
+
+def _nestest_trace(dispatch):
+    """
+    nestest 的自动模式从 $C000 开始, 一直执行到第一条非官方指令
+    :return: 每条指令执行前和最后的 (pc, a, x, y, p, sp, cycles), 和 $02 $03 的结果码
+    """
+    cpu, bus, cartridge = _build(dispatch)
+    cpu._program_counter = 0xC000
+    cpu._flag_i = 1
+
+    trace = []
+    while True:
+        trace.append((cpu.program_counter, cpu.accumulator, cpu.index_x, cpu.index_y,
+                      cpu.status, cpu.stack_pointer, cpu.cycles))
+        if bus.read_byte(cpu.program_counter) not in cpu.instruction_set:
+            break
+        # 预算 1 个周期, 三种方式都只执行一条指令
+        cpu.run(1)
+    result = bus.read_byte(0x02), bus.read_byte(0x03)
+    cartridge.close()
+    return trace, result
+
+
+def test_nestest():
+    trace, result = _nestest_trace('table')
+    # 官方指令全部通过, 停在第一条非官方指令 $C6BD
+    assert result == (0, 0)
+    assert trace[-1][0] == 0xC6BD
+    assert len(trace) == 5005
+
+
+def test_nestest_generated():
+    expected, _ = _nestest_trace('table')
+    trace, result = _nestest_trace('generated')
+    assert result == (0, 0)
+    assert trace == expected
+
+
+def test_nestest_recompiled():
+    # 预算 1 个周期时块退回到逐条执行, 每条指令之后的状态都要和逐条解释一样
+    expected, _ = _nestest_trace('table')
+    trace, result = _nestest_trace('recompiled')
+    assert result == (0, 0)
+    assert trace == expected
+
+
+def test_nestest_recompiled_blocks():
+    # 每个块第一次执行就编译, 预算是到 $C6BD 还剩的周期, 预算够的块整块执行
+    # 每次 run 之后的状态都要是逐条解释经过的状态, 最后停在同一个位置
+    expected, _ = _nestest_trace('table')
+    states = set(expected)
+    end = expected[-1][6]
+    hot = recompiler.HOT_BLOCK_COUNT
+    recompiler.HOT_BLOCK_COUNT = 0
+    try:
+        cpu, bus, cartridge = _build('recompiled')
+        cpu._program_counter = 0xC000
+        cpu._flag_i = 1
+        runs = 0
+        while cpu.cycles < end:
+            cpu.run(end - cpu.cycles)
+            runs += 1
+            state = (cpu.program_counter, cpu.accumulator, cpu.index_x, cpu.index_y,
+                     cpu.status, cpu.stack_pointer, cpu.cycles)
+            assert state in states, state
+        result = bus.read_byte(0x02), bus.read_byte(0x03)
+        cartridge.close()
+    finally:
+        recompiler.HOT_BLOCK_COUNT = hot
+    assert result == (0, 0)
+    assert state == expected[-1]
+    # 大部分指令在块里执行, 不是逐条退回
+    assert runs < len(expected) // 2
+
+
+def _oam_dma_stall(dispatch, code, cycles):
+    """
+    从 cycles 开始执行 RAM 里 $0300 的 code, 最后一条指令写 $4014
+    :return: 写完之后 CPU 暂停的周期
+    """
+    cpu, bus, cartridge = _build(dispatch)
+    for i, byte in enumerate(code):
+        bus.write_byte(0x0300 + i, byte)
+    cpu.run(1)
+    cpu._program_counter = 0x0300
+    cpu._cycles = cycles
+    while cpu.program_counter < 0x0300 + len(code):
+        cpu.run(1)
+    # 写 $4014 的指令之后第一次 run 先处理 DMA 暂停, 预算是 1 个周期, 不会再执行指令
+    stall = cpu.run(1)
+    cartridge.close()
+    return stall
+
+
+def test_oam_dma_stall():
+    # LDA #$02 STA $4014, 写的指令 4 个周期
+    absolute = [0xA9, 0x02, 0x8D, 0x14, 0x40]
+    # LDX #$14 STX $10 LDX #$40 STX $0011 LDA #$02 LDY #$00 STA ($10),Y, 一共 21 个周期, 写的指令 6 个周期
+    indirect = [0xA2, 0x14, 0x86, 0x10, 0xA2, 0x40, 0x8E, 0x11, 0x00, 0xA9, 0x02, 0xA0, 0x00, 0x91, 0x10]
+    for dispatch in ('table', 'generated', 'recompiled'):
+        # 写 $4014 的指令之后的第一个周期是偶数时暂停 513 个周期, 奇数时 514 个
+        assert _oam_dma_stall(dispatch, absolute, 100) == 513, dispatch
+        assert _oam_dma_stall(dispatch, absolute, 101) == 514, dispatch
+        assert _oam_dma_stall(dispatch, indirect, 100) == 514, dispatch
+        assert _oam_dma_stall(dispatch, indirect, 101) == 513, dispatch
@@ -0,0 +1,125 @@
+import os
+import re
+import tempfile
+
+from console import Console
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# MMC3 的 IRQ latch, 每 21 条扫描线产生一次 IRQ
+IRQ_LATCH = 20
+
+
+def _mmc3_rom():
+    """
+    生成一个 MMC3 的 ROM, 32KB PRG 4 个 8KB bank, 每个 bank 第一个字节是 bank 号, CHR 全是 0
+    reset 打开渲染和 IRQ, 之后原地循环
+    IRQ 里 $10 加 1, 用 $10 的低 2 位切换 R6, 再把 $8000 的 bank 号存进 $11
+    """
+    prg = bytearray(0x8000)
+    for bank in range(4):
+        prg[bank * 0x2000] = bank
+
+    reset = [
+        0x78, 0xA2, 0xFF, 0x9A,                 # SEI LDX #$FF TXS
+        0x2C, 0x02, 0x20, 0x10, 0xFB,           # BIT $2002 BPL, 等两次 vblank
+        0x2C, 0x02, 0x20, 0x10, 0xFB,
+        0xA9, 0x08, 0x8D, 0x00, 0x20,           # LDA #$08 STA $2000, sprite 用 $1000
+        0xA9, 0x1E, 0x8D, 0x01, 0x20,           # LDA #$1E STA $2001
+        0xA9, 0x06, 0x8D, 0x00, 0x80,           # LDA #$06 STA $8000, 选择 R6
+        0xA9, IRQ_LATCH, 0x8D, 0x00, 0xC0,      # STA $C000, latch
+        0x8D, 0x01, 0xC0,                       # STA $C001, reload
+        0x8D, 0x01, 0xE0,                       # STA $E001, 允许 IRQ
+        0x58,                                   # CLI
+        0x4C, 0x29, 0xE0,                       # JMP $E029
+    ]
+    irq = [
+        0x48,                                   # PHA
+        0x8D, 0x00, 0xE0,                       # STA $E000, 撤销 IRQ
+        0x8D, 0x01, 0xE0,                       # STA $E001
+        0xE6, 0x10,                             # INC $10
+        0xA5, 0x10, 0x29, 0x03,                 # LDA $10 AND #$03
+        0x8D, 0x01, 0x80,                       # STA $8001, R6
+        0xAD, 0x00, 0x80,                       # LDA $8000, bank 号
+        0x85, 0x11,                             # STA $11
+        0x68, 0x40,                             # PLA RTI
+    ]
+    # $E000 是最后一个 bank
+    prg[0x6000:0x6000 + len(reset)] = bytes(reset)
+    prg[0x6100:0x6100 + len(irq)] = bytes(irq)
+    # NMI reset IRQ 向量
+    prg[0x7FFA:0x8000] = bytes([0x00, 0xE1, 0x00, 0xE0, 0x00, 0xE1])
+
+    header = b'NES\x1a' + bytes([2, 2, 0x40, 0, 0]) + bytes(7)
+    return header + bytes(prg) + bytes(0x4000)
+
+
+def _irq_cycles(path, dispatch, idle_skip, mode, frames):
+    """
+    :return: 每次 IRQ 时的 CPU 周期, $11 和最后的 CPU 周期
+    """
+    console = Console(path, dispatch=dispatch, idle_skip=idle_skip)
+    cpu = console.cpu
+    cycles = []
+    handle_irq = cpu.handle_irq
+
+    def record():
+        cycles.append(cpu.cycles)
+        return handle_irq()
+
+    cpu.handle_irq = record
+    run = getattr(console, mode)
+    while console.ppu.frame < frames:
+        run()
+    bank = console._cpu_bus.read_byte(0x11)
+    result = cycles, bank, cpu.cycles
+    console.close()
+    return result
+
+
+def test_mmc3_irq():
+    with tempfile.NamedTemporaryFile(suffix='.nes', delete=False) as f:
+        f.write(_mmc3_rom())
+    try:
+        expected = _irq_cycles(f.name, 'table', False, 'step', 5)
+        for dispatch in ('table', 'generated', 'recompiled'):
+            for idle_skip in (False, True):
+                for mode in ('step', 'run_frame'):
+                    result = _irq_cycles(f.name, dispatch, idle_skip, mode, 5)
+                    assert result == expected, (dispatch, idle_skip, mode)
+    finally:
+        os.remove(f.name)
+
+    cycles, bank, _ = expected
+    # IRQ 里切换的 R6 生效
+    assert bank == len(cycles) & 0x03
+    # 同一帧里相邻的 IRQ 相隔 latch + 1 条扫描线
+    lines = [(c * 3 % (262 * 341)) // 341 for c in cycles]
+    gaps = [b - a for a, b in zip(lines, lines[1:]) if b > a]
+    assert gaps
+    assert all(gap == IRQ_LATCH + 1 for gap in gaps)
+
+
+def test_mmc1():
+    """
+    blargg 的 instr_test-v5 official_only, MMC1 的 PRG 切换在测试之间进行
+    结果写在 $6000, 0 是全部通过, $6001-$6003 是 DE B0 61, $6004 开始是结果文字
+    有测试失败时文字里是 "test N of 16", N 是第一个失败的测试
+    """
+    console = Console(os.path.join(ROOT, 'official_only.nes'))
+    bus = console._cpu_bus
+    status = 0x80
+    while console.ppu.frame < 2400:
+        console.run_frame()
+        status = bus.read_byte(0x6000)
+        if status < 0x80 and bus.read_word(0x6001) == 0xB0DE:
+            break
+    text = bytes(bus.read_byte(0x6004 + i) for i in range(400)).split(b'\0')[0]
+    console.close()
+    assert status < 0x80
+    if status != 0:
+        # 前 14 个测试都要通过, 第 15 个 (BRK) 开始的失败是 CPU 的问题, 和 MMC1 无关
+        failed = re.search(rb'test (\d+) of (\d+)', text)
+        assert failed is not None, text
+        assert int(failed.group(1)) >= 15, text
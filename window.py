@@ -2,18 +2,29 @@ import pygame
 import math
 from random import random
 
+from memory.palettes import emphasized_palettes
+
 
 class Window:
-    def __init__(self):
+    def __init__(self, scale=1):
+        """
+        :param scale: 整数倍放大, 窗口大小是 256 * scale, 240 * scale
+        """
         self.size = (256, 240)
-        self._canvas = pygame.display.set_mode(self.size)
+        self._scale = scale
+        w, h = self.size
+        self._canvas = pygame.display.set_mode((w * scale, h * scale))
         self._key_events_handlers = dict()
         self.running = True
-        r1 = math.floor(random() * 255)
-        r2 = math.floor(random() * 255)
-        r3 = math.floor(random() * 255)
+        # 画面是 NES 颜色下标, 一次写进 8 位调色板 surface, 颜色强调改变时才换调色板
+        # 放大时先缩放到同样格式的 surface, transform.scale 要求目标和源格式相同
+        self._frame = pygame.Surface(self.size, depth=8)
+        self._scaled = pygame.Surface(self._canvas.get_size(), depth=8) if scale > 1 else None
+        self._emphasis = 0
+        self._set_palette(emphasized_palettes(self._emphasis))
+        r = math.floor(random() * 64)
 
-        pixels = [(r1, r2, r3)] * 256 * 240
+        pixels = bytearray([r]) * 256 * 240
         self.pixels = pixels
 
     def draw_point(self, x, y, color):
@@ -33,8 +44,16 @@ class Window:
             self.draw_line(x, y, width, color)
             y += 1
 
-    def update_frame(self, buffer):
+    def update_frame(self, buffer, emphasis=0):
         self.pixels = buffer
+        if emphasis != self._emphasis:
+            self._emphasis = emphasis
+            self._set_palette(emphasized_palettes(emphasis))
+
+    def _set_palette(self, colors):
+        self._frame.set_palette(colors)
+        if self._scaled is not None:
+            self._scaled.set_palette(colors)
 
     def register_key_event_handler(self, key, handler):
         self._key_events_handlers[key] = handler
@@ -51,19 +70,21 @@ class Window:
                 key_up()
 
     def update(self):
-        pygame.display.flip()
+        """
+        处理窗口事件, 画面在 draw 之后才刷新
+        """
         self._update_events()
 
     def clear(self):
         pass
 
     def draw(self):
-        w, h = self.size
-        i = 0
-        while i < w:
-            j = 0
-            while j < h:
-                pixel = self.pixels[i + (j * w)]
-                self.draw_point(i, j, pixel)
-                j += 1
-            i += 1
+        """
+        8 位 surface 一行正好 256 字节, 整帧一次写进像素缓冲区
+        """
+        frame = self._frame
+        frame.get_buffer().write(bytes(self.pixels), 0)
+        if self._scaled is not None:
+            frame = pygame.transform.scale(frame, self._scaled.get_size(), self._scaled)
+        self._canvas.blit(frame, (0, 0))
+        pygame.display.flip()